@@ -0,0 +1,412 @@
+"""Bot throughput without Telegram: updates replayed through the Dispatcher.
+
+Synthetic users browse a category, page through it, buy a product and check
+the payment; a share of them pays first. Recorded updates (one Update JSON per
+line, as Telegram sends them) can be replayed instead with --updates.
+
+    python -m benchmarks.bot_replay --users 2000 --concurrency 200 --output run.json
+    python -m benchmarks.bot_replay --updates recorded.jsonl --tracemalloc
+
+The Bot session is replaced by one that answers every call locally, records it
+and optionally adds --api-latency-ms. The database is a seeded SQLite file (or
+--db-url), Redis is fakeredis (or --redis-url).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+import orjson
+
+# Per update counters, shared with the tasks a handler spawns
+current_update: ContextVar[dict | None] = ContextVar("current_update", default=None)
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def latency_summary(values: list[float]) -> dict:
+    ordered = sorted(values)
+    return {
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+    }
+
+
+def make_recording_session(api_latency: float):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import GetMe, SendMessage, SendPhoto
+    from aiogram.types import InlineKeyboardMarkup
+
+    class RecordingSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = defaultdict(list)
+            self.offered = defaultdict(list)
+            self.message_id = 0
+
+        def _message(self, method) -> dict:
+            self.message_id += 1
+            message = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': method.chat_id, 'type': 'private'},
+            }
+            if isinstance(method, SendPhoto):
+                photo = method.photo if isinstance(method.photo, str) else f'file-{method.photo.path}'
+                message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 800, 'height': 800}]
+                message['caption'] = method.caption
+            else:
+                message['text'] = method.text
+            return message
+
+        async def make_request(self, bot, method, timeout=None):
+            started = time.perf_counter()
+            if api_latency:
+                await asyncio.sleep(api_latency)
+            if isinstance(method, GetMe):
+                result = {'id': 1, 'is_bot': True, 'first_name': 'Store', 'username': 'store_bot'}
+            elif isinstance(method, (SendMessage, SendPhoto)):
+                result = self._message(method)
+                if isinstance(method.reply_markup, InlineKeyboardMarkup):
+                    self.offered[method.chat_id].extend(
+                        button.callback_data for row in method.reply_markup.inline_keyboard
+                        for button in row if button.callback_data)
+            else:
+                result = True
+            response = self.check_response(bot=bot, method=method, status_code=200,
+                                           content=orjson.dumps({'ok': True, 'result': result}).decode())
+            name = type(method).__name__
+            self.calls[name].append(time.perf_counter() - started)
+            if (update := current_update.get()) is not None:
+                update['api_calls'] += 1
+            return response.result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b''
+
+        async def close(self):
+            pass
+
+    return RecordingSession()
+
+
+def make_offline_quickpay():
+    import httpx
+    from yoomoney import Quickpay
+
+    class OfflineQuickpay(Quickpay):
+        # Builds the form URL without posting it to YooMoney
+        def _request(self):
+            self.base_url = self.redirected_url = str(httpx.Request("GET", self._BASE, params=self._build_params()).url)
+            return None
+
+    return OfflineQuickpay
+
+
+class Replay:
+    def __init__(self, dp, bot, session, redis, paid_ratio: float):
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.redis = redis
+        self.paid_ratio = paid_ratio
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+        self.counters = defaultdict(Counter)
+        self.errors = Counter()
+
+    async def feed(self, step: str, update) -> list[str]:
+        chat_id = update.message.chat.id if update.message else update.callback_query.from_user.id
+        self.session.offered.pop(chat_id, None)
+        stats = {'api_calls': 0, 'db_queries': 0}
+        token = current_update.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[f'{step}: {type(e).__name__}'] += 1
+        finally:
+            current_update.reset(token)
+        self.latencies[step].append(time.perf_counter() - started)
+        counters = self.counters[step]
+        counters['updates'] += 1
+        counters.update(stats)
+        return self.session.offered.pop(chat_id, [])
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def command(self, user_id: int, text: str):
+        from aiogram.types import Update
+
+        return Update.model_validate({
+            'update_id': self._next_id(),
+            'message': {
+                'message_id': self._next_id(),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+            },
+        }, context={'bot': self.bot})
+
+    def click(self, user_id: int, data: str):
+        from aiogram.types import Update
+
+        return Update.model_validate({
+            'update_id': self._next_id(),
+            'callback_query': {
+                'id': str(self._next_id()),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': self._next_id(),
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'menu',
+                },
+            },
+        }, context={'bot': self.bot})
+
+    async def user(self, user_id: int, pages: int):
+        # Follows the buttons the bot actually sent, like a person would
+        from database import async_session
+        from models import Categories
+        from payment_system import PENDING_DATA_KEY, confirm_payment
+
+        await self.feed('start', self.command(user_id, '/start'))
+        offered = await self.feed('catalog', self.click(user_id, f'catalog_{random.choice(list(Categories)).value}'))
+        for page_num in range(1, pages + 1):
+            if f'page_{page_num}' not in offered:
+                break
+            offered = await self.feed('page', self.click(user_id, f'page_{page_num}'))
+        buy = [data for data in offered if data.startswith('buy_')]
+        if not buy:
+            return
+        offered = await self.feed('buy', self.click(user_id, random.choice(buy)))
+        check = [data for data in offered if data.startswith('check_')]
+        if not check:
+            return
+        if random.random() < self.paid_ratio:
+            label = check[0].split('_')[1]
+            payment = orjson.loads(await self.redis.hget(PENDING_DATA_KEY, label))
+            async with async_session() as session:
+                await confirm_payment(self.redis, session, label, payment['price'])
+        await self.feed('check', self.click(user_id, check[0]))
+
+    async def recorded(self, updates: list):
+        # Updates of one chat stay in order, chats run concurrently
+        for update in updates:
+            if update.callback_query and update.callback_query.data:
+                step = update.callback_query.data.split('_')[0]
+            elif update.message and update.message.text and update.message.text.startswith('/'):
+                step = update.message.text.split()[0]
+            else:
+                step = update.event_type
+            await self.feed(step, update)
+
+
+def sqlite_functions(engine):
+    # The payments.date default is TIMEZONE('utc', now()), give SQLite both
+    from sqlalchemy import event
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function(
+            "now", 0, lambda: datetime.datetime.now(datetime.UTC).strftime('%Y-%m-%d %H:%M:%S.%f'))
+        dbapi_connection.create_function("TIMEZONE", 2, lambda zone, value: value)
+
+
+async def seed(products: int, keys_per_product: int):
+    from sqlalchemy import insert
+
+    from database import async_session, create_tables, delete_tables
+    from models import Categories, KeysModel, ProductsModel
+
+    await delete_tables()
+    await create_tables()
+    categories = list(Categories)
+    async with async_session() as session:
+        await session.execute(insert(ProductsModel), [
+            {
+                'title': f'Product {i}',
+                'description': 'Lorem ipsum dolor sit amet ' * 8,
+                'category': categories[i % len(categories)],
+                'price': 100 + i,
+                'image': f'images/{i}.png',
+                'stock': keys_per_product,
+            }
+            for i in range(1, products + 1)
+        ])
+        rows = [
+            {'item': f'KEY-{product_id}-{n}', 'product_id': product_id}
+            for product_id in range(1, products + 1)
+            for n in range(keys_per_product)
+        ]
+        for start in range(0, len(rows), 10000):
+            await session.execute(insert(KeysModel), rows[start:start + 10000])
+        await session.commit()
+
+
+async def main(args, workdir: str) -> dict:
+    os.environ.setdefault('DB_URL', args.db_url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'store.db')}")
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+    if args.redis_url:
+        os.environ['REDIS_URL'] = args.redis_url
+
+    # Settings are read from the environment at import time
+    from aiogram.fsm.storage.redis import RedisStorage
+    from aiogram.types import Update
+    from sqlalchemy import event
+
+    import database
+    import payment_system
+    from bot import FSM_TTL, db_middleware, dp
+    from payment_system import PaymentReconciler, YooMoneyProvider
+    from sender import send_scheduler
+    from telegram_router import bot, notify_paid
+
+    logging.getLogger('aiogram').setLevel(logging.WARNING)
+    logging.getLogger('slow_queries').setLevel(logging.ERROR)
+
+    if database.DB_URL.startswith('sqlite'):
+        sqlite_functions(database.engine)
+    if not args.redis_url:
+        from fakeredis import FakeAsyncRedis
+
+        database.redis_client = FakeAsyncRedis()
+    redis = await database.init_redis()
+    dp.fsm.storage = RedisStorage(redis, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    dp['reconciler'] = PaymentReconciler(redis, database.async_session, YooMoneyProvider(), notify=notify_paid)
+    payment_system.Quickpay = make_offline_quickpay()
+
+    session = make_recording_session(args.api_latency_ms / 1000)
+    if args.rate_limit:
+        session.middleware(send_scheduler)
+    bot.session = session
+
+    @event.listens_for(database.engine.sync_engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if (update := current_update.get()) is not None:
+            update['db_queries'] += 1
+
+    await seed(args.products, args.keys_per_product)
+    replay = Replay(dp, bot, session, redis, args.paid_ratio)
+
+    if args.updates:
+        chats = defaultdict(list)
+        with open(args.updates, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    update = Update.model_validate(orjson.loads(line), context={'bot': bot})
+                    event_object = update.event
+                    chat = getattr(getattr(event_object, 'chat', None), 'id', None) or event_object.from_user.id
+                    chats[chat].append(update)
+        jobs = [replay.recorded(updates) for updates in chats.values()]
+    else:
+        jobs = [replay.user(user_id, args.pages) for user_id in range(1, args.users + 1)]
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(job):
+        async with semaphore:
+            await job
+
+    if args.tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(job) for job in jobs))
+    elapsed = time.perf_counter() - started
+
+    updates = sum(counters['updates'] for counters in replay.counters.values())
+    report = {
+        'config': {**vars(args), 'db_url': database.DB_URL, 'redis': args.redis_url or 'fakeredis'},
+        'updates': updates,
+        'seconds': round(elapsed, 4),
+        'updates_per_sec': round(updates / elapsed, 1),
+        'steps': {
+            step: {
+                'updates': counters['updates'],
+                **latency_summary(replay.latencies[step]),
+                'api_calls_per_update': round(counters['api_calls'] / counters['updates'], 2),
+                'db_queries_per_update': round(counters['db_queries'] / counters['updates'], 2),
+            }
+            for step, counters in replay.counters.items()
+        },
+        'api_calls': {
+            method: {'calls': len(timings), **latency_summary(timings)}
+            for method, timings in sorted(session.calls.items())
+        },
+        'handlers': db_middleware.stats(),
+        'errors': dict(replay.errors),
+        'memory': {
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_growth_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+        },
+    }
+    if args.tracemalloc:
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'lineno')
+        report['memory'].update({
+            'traced_growth_kib': round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            'traced_peak_kib': round(peak / 1024, 1),
+            'top_growth': [
+                {'where': str(stat.traceback), 'kib': round(stat.size_diff / 1024, 1), 'blocks': stat.count_diff}
+                for stat in stats[:10]
+            ],
+        })
+
+    await database.close_resources()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url', help='disposable database, a temporary SQLite file by default')
+    parser.add_argument('--redis-url', help='local Redis, fakeredis by default')
+    parser.add_argument('--products', type=int, default=300)
+    parser.add_argument('--keys-per-product', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=2, help='pages each user flips through before buying')
+    parser.add_argument('--paid-ratio', type=float, default=0.5, help='share of users who pay before checking')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='simulated Telegram round trip')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the outgoing SendScheduler limits')
+    parser.add_argument('--updates', help='replay recorded updates, one Update JSON per line')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace allocations, slows the run down')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file as well')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='bot_replay_')
+    try:
+        result = json.dumps(asyncio.run(main(args, workdir)), indent=2, ensure_ascii=False)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result)
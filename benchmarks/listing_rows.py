@@ -0,0 +1,84 @@
+"""Rows/sec of the product listing mapping, ORM entities vs column projection.
+
+    python -m benchmarks.listing_rows --products 20000 --page 1000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import orjson
+from sqlalchemy import select, asc, insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from models import Model, ProductsModel, Categories
+from queries import select_all_products
+from schemas import ProductsGet
+
+
+async def seed(session, products: int):
+    categories = list(Categories)
+    rows = [
+        {
+            'title': f'Product {i}',
+            'description': 'Lorem ipsum dolor sit amet ' * 8,
+            'category': categories[i % len(categories)],
+            'price': 100 + i,
+            'image': f'images/{i}.png',
+            'stock': i % 50,
+        }
+        for i in range(products)
+    ]
+    await session.execute(insert(ProductsModel), rows)
+    await session.commit()
+
+
+async def orm_listing(session, limit: int, offset: int) -> bytes:
+    # The listing as it was before column projection
+    query = select(ProductsModel).order_by(asc(ProductsModel.id)).offset(offset).limit(limit)
+    result = await session.execute(query)
+    res = [product.as_dict_with_remainder() for product in result.scalars().all()]
+    for item in res:
+        item['category'] = item['category'].value
+    products = [ProductsGet.model_validate(item) for item in res]
+    return json.dumps([item.model_dump() for item in products]).encode()
+
+
+async def projected_listing(session, limit: int, offset: int) -> bytes:
+    return orjson.dumps(await select_all_products(session, limit, offset))
+
+
+async def measure(name, fn, session_maker, products: int, page: int) -> dict:
+    rows = 0
+    started = time.perf_counter()
+    for offset in range(0, products, page):
+        async with session_maker() as session:
+            await fn(session, page, offset)
+        rows += min(page, products - offset)
+    elapsed = time.perf_counter() - started
+    return {'variant': name, 'rows': rows, 'seconds': round(elapsed, 4), 'rows_per_sec': round(rows / elapsed)}
+
+
+async def main(products: int, page: int):
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Model.metadata.create_all)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    async with session_maker() as session:
+        await seed(session, products)
+
+    report = [
+        await measure('orm_entities', orm_listing, session_maker, products, page),
+        await measure('column_projection', projected_listing, session_maker, products, page),
+    ]
+    print(json.dumps(report, indent=2))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--page', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.products, args.page))
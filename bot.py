@@ -1,30 +1,118 @@
 import asyncio
+import hmac
 import logging
 import os
+from typing import Annotated
 
 from aiogram import Dispatcher
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import Update
 from dotenv import load_dotenv
+from fastapi import APIRouter, Header, HTTPException, Request
+from prometheus_client import start_http_server
 
-from database import async_session
-from middleware import DatabaseMiddleware
-from telegram_router import router, bot
+from cache import start_invalidation_listener
+from database import async_session, init_redis, close_resources
+from images import shutdown_image_pool
+from middleware import DatabaseMiddleware, MetricsMiddleware
+from payment_system import PaymentReconciler, YooMoneyProvider
+from telegram_router import router, bot, notify_paid
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("BOT_TOKEN")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", 0))
 
-
+# The Redis FSM storage is attached on startup, once the shared client exists
 dp = Dispatcher()
-dp.update.middleware(DatabaseMiddleware(session_pool=async_session))
+# Registered on the handler level, so the middleware knows which handler runs
+db_middleware = DatabaseMiddleware(session_pool=async_session)
+metrics_middleware = MetricsMiddleware()
+for observer in (router.message, router.callback_query):
+    observer.middleware(metrics_middleware)
+    observer.middleware(db_middleware)
+dp.include_router(router)
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(os.name)
 
 
+background_tasks = []
+webhook_updates = set()
+
+
+async def on_startup():
+    redis = await init_redis()
+    # Abandoned sessions expire on their own, the state survives restarts and is
+    # shared by every bot worker. It uses the shared pool instead of opening its own
+    dp.fsm.storage = RedisStorage(redis, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    reconciler = PaymentReconciler(redis, async_session, YooMoneyProvider(), notify=notify_paid)
+    dp["reconciler"] = reconciler
+    background_tasks.append(asyncio.create_task(reconciler.run()))
+    if listener := start_invalidation_listener(redis):
+        background_tasks.append(listener)
+
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    shutdown_image_pool()
+    await close_resources()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+webhook_router = APIRouter(
+    prefix="",
+    tags=["Telegram"],
+)
+
+
+@webhook_router.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(
+        request: Request,
+        x_telegram_bot_api_secret_token: Annotated[str | None, Header()] = None
+):
+    if not WEBHOOK_SECRET or not hmac.compare_digest(x_telegram_bot_api_secret_token or "", WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail='Invalid secret token.')
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    # Answer Telegram at once, the update is handled in the background
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    webhook_updates.add(task)
+    task.add_done_callback(webhook_updates.discard)
+    return {"ok": True}
+
+
+async def start_webhook():
+    await dp.emit_startup(bot=bot)
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+
+async def stop_webhook():
+    if webhook_updates:
+        await asyncio.wait(webhook_updates, timeout=10)
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+
 async def run_bot():
-    dp.include_router(router)
+    # In webhook mode the bot's metrics are served by the API's /metrics
+    if BOT_METRICS_PORT:
+        start_http_server(BOT_METRICS_PORT)
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    asyncio.run(run_bot())
\ No newline at end of file
+    asyncio.run(run_bot())
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+from typing import Iterable
+
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+PRODUCTS_CACHE_TTL = int(os.getenv("PRODUCTS_CACHE_TTL", 3600))
+L1_CACHE_SIZE = int(os.getenv("L1_CACHE_SIZE", 512))
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", 30))
+FILL_LOCK_TTL = float(os.getenv("CACHE_FILL_LOCK_TTL", 5))
+FILL_WAIT_TIMEOUT = float(os.getenv("CACHE_FILL_WAIT_TIMEOUT", 2))
+XFETCH_BETA = float(os.getenv("CACHE_XFETCH_BETA", 1))
+GLOBAL_VERSION_KEY = "products:version"
+INVALIDATION_CHANNEL = "products:invalidate"
+
+logger = logging.getLogger('cache')
+
+
+class LocalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data: OrderedDict[str, tuple[float, str | None, object]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value, category: str | None = None, generation: int | None = None):
+        # A value loaded before an invalidation arrived must not be stored
+        if self.maxsize <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._data[key] = (time.monotonic() + self.ttl, category, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, categories: Iterable[str]):
+        # Entries without a category are global listings and depend on all of them
+        self.generation += 1
+        stale = [key for key, (_, category, _) in self._data.items()
+                 if category is None or category in categories]
+        for key in stale:
+            del self._data[key]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # One cancelled caller must not cancel the fetch shared by the others
+        return await asyncio.shield(task)
+
+
+local_cache = LocalCache(L1_CACHE_SIZE, L1_CACHE_TTL)
+single_flight = SingleFlight()
+
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+async def acquire_fill_lock(redis: Redis, key: str) -> str | None:
+    token = uuid.uuid4().hex
+    if await redis.set(f"lock:{key}", token, nx=True, px=int(FILL_LOCK_TTL * 1000)):
+        return token
+    return None
+
+
+async def release_fill_lock(redis: Redis, key: str, token: str):
+    await redis.eval(_RELEASE_LOCK, 1, f"lock:{key}", token)
+
+
+async def wait_for_fill(redis: Redis, key: str, fields) -> list | None:
+    deadline = time.monotonic() + FILL_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        values = await redis.hmget(key, *fields)
+        if values[0] is not None:
+            return values
+    return None
+
+
+def should_refresh_early(delta: float, ttl_ms: int) -> bool:
+    # Probabilistic early expiration (XFetch): the closer the key is to expiry
+    # and the slower it is to rebuild, the more likely one reader rebuilds it
+    if ttl_ms <= 0:
+        return False
+    return delta * XFETCH_BETA * -math.log(1.0 - random.random()) >= ttl_ms / 1000
+
+
+def category_version_key(category: str) -> str:
+    return f"products:version:{category}"
+
+
+def _category_name(category) -> str:
+    return getattr(category, "value", category)
+
+
+async def get_version(redis: Redis, category: str | None = None) -> int:
+    key = GLOBAL_VERSION_KEY if category is None else category_version_key(category)
+    return int(await redis.get(key) or 0)
+
+
+def touch_categories(session, *categories):
+    # Remember what a write changed, so the caller can invalidate the
+    # listings once the transaction is committed
+    touched = session.info.setdefault("touched_categories", set())
+    touched.update(_category_name(category) for category in categories if category is not None)
+
+
+async def bump_versions(redis: Redis, categories):
+    local_cache.invalidate(set(categories))
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.incr(GLOBAL_VERSION_KEY)
+        for category in categories:
+            pipe.incr(category_version_key(category))
+        pipe.publish(INVALIDATION_CHANNEL, ",".join(categories))
+        await pipe.execute()
+
+
+async def invalidate_touched(redis: Redis, session):
+    categories = session.info.pop("touched_categories", None)
+    if categories:
+        await bump_versions(redis, categories)
+
+
+async def listen_for_invalidations(redis: Redis, cache: LocalCache = local_cache):
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Messages may have been missed while we were not subscribed
+            cache.clear()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    cache.invalidate(set(message["data"].decode().split(",")))
+        except (ConnectionError, TimeoutError):
+            logger.warning("Lost the cache invalidation channel, reconnecting")
+            cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+_listener: asyncio.Task | None = None
+
+
+def start_invalidation_listener(redis: Redis) -> asyncio.Task | None:
+    # The API and the bot share one listener when they run in the same process
+    global _listener
+    if local_cache.maxsize <= 0:
+        return None
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(listen_for_invalidations(redis))
+    return _listener
@@ -1,17 +1,95 @@
 import os
 
 from dotenv import load_dotenv
+from redis.asyncio import ConnectionPool, Redis
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
+from metrics import TimedQueuePool, instrument_engine
 from models import Model
+from slow_queries import instrument_slow_queries
 
 load_dotenv()
+
+DB_URL = os.getenv("DB_URL")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+
+def _engine_options(url: str) -> dict:
+    # SQLite uses its own pool class that does not accept size settings
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True,
+        "poolclass": TimedQueuePool,
+    }
+
+
 engine = create_async_engine(
-    url=os.getenv("DB_URL")
+    url=DB_URL,
+    **_engine_options(DB_URL)
 )
 
+instrument_engine(engine)
+instrument_slow_queries(engine)
+
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
+redis_pool: ConnectionPool | None = None
+redis_client: Redis | None = None
+
+
+async def init_redis() -> Redis:
+    global redis_pool, redis_client
+    if redis_client is None:
+        redis_pool = ConnectionPool.from_url(
+            REDIS_URL,
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 5)),
+            socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", 5)),
+            health_check_interval=int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+        )
+        redis_client = Redis(connection_pool=redis_pool)
+    return redis_client
+
+
+def get_redis_client() -> Redis:
+    if redis_client is None:
+        raise RuntimeError("Redis is not initialised, call init_redis() on startup")
+    return redis_client
+
+
+async def close_resources():
+    global redis_pool, redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        if redis_pool is not None:
+            await redis_pool.disconnect()
+        redis_pool = None
+        redis_client = None
+    await engine.dispose()
+
+
+def pool_stats() -> dict:
+    stats = {"db": {"status": engine.pool.status()}}
+    if hasattr(engine.pool, "checkedout"):
+        stats["db"].update(
+            size=engine.pool.size(),
+            checked_in=engine.pool.checkedin(),
+            checked_out=engine.pool.checkedout(),
+            overflow=engine.pool.overflow(),
+        )
+    if redis_pool is not None:
+        stats["redis"] = {
+            "max_connections": redis_pool.max_connections,
+            "in_use": len(redis_pool._in_use_connections),
+            "available": len(redis_pool._available_connections),
+        }
+    return stats
+
 
 async def create_tables():
     async with engine.begin() as conn:
@@ -20,4 +98,4 @@ async def create_tables():
 
 async def delete_tables():
     async with engine.begin() as conn:
-        await conn.run_sync(Model.metadata.drop_all)
\ No newline at end of file
+        await conn.run_sync(Model.metadata.drop_all)
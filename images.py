@@ -0,0 +1,62 @@
+import asyncio
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+IMAGES_DIR = os.getenv("IMAGES_DIR", "images")
+IMAGE_MAX_SIZE = int(os.getenv("IMAGE_MAX_SIZE", 1280))
+IMAGE_THUMB_SIZE = int(os.getenv("IMAGE_THUMB_SIZE", 320))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+# name: (longest side, format, extension)
+VARIANTS = {
+    "image": (IMAGE_MAX_SIZE, "JPEG", "jpg"),
+    "image_webp": (IMAGE_MAX_SIZE, "WEBP", "webp"),
+    "thumbnail": (IMAGE_THUMB_SIZE, "JPEG", "jpg"),
+}
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def process_image(data: bytes, directory: str = IMAGES_DIR) -> dict[str, str]:
+    # Files are named after the upload's content, the same image is stored once
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    paths = {name: os.path.join(directory, f"{digest}_{name}.{ext}")
+             for name, (_, _, ext) in VARIANTS.items()}
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    os.makedirs(directory, exist_ok=True)
+    with Image.open(io.BytesIO(data)) as source:
+        # Pixels only: orientation is applied, EXIF and other metadata are dropped
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    for name, (size, fmt, _) in VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.Resampling.LANCZOS)
+        tmp_path = f"{paths[name]}.tmp"
+        variant.save(tmp_path, fmt, quality=IMAGE_QUALITY, optimize=True)
+        os.replace(tmp_path, paths[name])
+    return paths
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+async def ingest_image(data: bytes) -> dict[str, str]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), process_image, data)
+
+
+def shutdown_image_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -1,19 +1,41 @@
-from fastapi import FastAPI
+import os
+from contextlib import asynccontextmanager
 
-from router import router
 from fastapi import FastAPI
 
+from cache import start_invalidation_listener
+from database import init_redis, close_resources
+from metrics import metrics_middleware, render_metrics
 from router import router
 
-# @asynccontextmanager
-# async def lifespan(app: FastAPI):
-#     await delete_tables()
-#     print('База очищена')
-#     await create_tables()
-#     print('База готова к работе')
-#     yield
-#     print("Выключение")lifespan=lifespan
+WEBHOOK_MODE = os.getenv("BOT_MODE", "polling") == "webhook"
+if WEBHOOK_MODE:
+    from bot import webhook_router, start_webhook, stop_webhook
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    redis = await init_redis()
+    await redis.ping()
+    listener = start_invalidation_listener(redis)
+    if WEBHOOK_MODE:
+        await start_webhook()
+    yield
+    if WEBHOOK_MODE:
+        await stop_webhook()
+    if listener is not None:
+        listener.cancel()
+    await close_resources()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(metrics_middleware)
+
+app.include_router(router)
+if WEBHOOK_MODE:
+    app.include_router(webhook_router)
 
-app = FastAPI()
 
-app.include_router(router)
\ No newline at end of file
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return render_metrics()
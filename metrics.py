@@ -0,0 +1,92 @@
+import os
+import time
+
+from fastapi import Request, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from slow_queries import query_context
+
+# One naming scheme for the API and the bot: store_<subsystem>_<name>
+HTTP_REQUEST_DURATION = Histogram(
+    "store_http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+HTTP_IN_FLIGHT = Gauge(
+    "store_http_requests_in_flight", "HTTP requests being handled", multiprocess_mode="livesum"
+)
+DB_QUERY_DURATION = Histogram(
+    "store_db_query_duration_seconds", "SQL statement latency", ["operation"]
+)
+DB_POOL_WAIT = Histogram(
+    "store_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled DB connection"
+)
+CACHE_REQUESTS = Counter(
+    "store_cache_requests_total", "Product listing cache lookups", ["layer", "result"]
+)
+BOT_HANDLER_DURATION = Histogram(
+    "store_bot_handler_duration_seconds", "Bot handler latency", ["handler"]
+)
+TELEGRAM_API_DURATION = Histogram(
+    "store_telegram_api_duration_seconds", "Outgoing Telegram API call latency", ["method"]
+)
+TELEGRAM_QUEUE_DEPTH = Gauge(
+    "store_telegram_queue_depth", "Outgoing Telegram calls waiting or in flight", multiprocess_mode="livesum"
+)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "unknown"
+        DB_QUERY_DURATION.labels(operation).observe(time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
+
+
+async def metrics_middleware(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
+    token = query_context.set(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        query_context.reset(token)
+        # The route template keeps the label set bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_DURATION.labels(request.method, path, str(status)).observe(time.perf_counter() - started)
+
+
+def render_metrics() -> Response:
+    # With several uvicorn workers every process writes to PROMETHEUS_MULTIPROC_DIR
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,12 +1,78 @@
+import time
+from collections import defaultdict
 from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import BaseMiddleware
 from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from metrics import BOT_HANDLER_DURATION
+from slow_queries import query_context
+
+
+class LazySession:
+    # Stands in for AsyncSession. A session is only opened on first use, and
+    # after a read with nothing left to write the transaction is ended, so the
+    # connection goes back to the pool while the handler talks to Telegram.
+    def __init__(self, session_pool, counters: dict):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+        self._counters = counters
+        self._writing = False
+
+    def _get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+            self._counters["sessions"] += 1
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    async def execute(self, statement, *args, **kwargs):
+        self._counters["queries"] += 1
+        session = self._get()
+        # Checked before executing, autoflush empties session.new
+        if session.new or session.dirty or session.deleted:
+            self._writing = True
+        if not getattr(statement, "is_select", False) or getattr(statement, "_for_update_arg", None) is not None:
+            self._writing = True
+        result = await session.execute(statement, *args, **kwargs)
+        if not self._writing:
+            # Results of AsyncSession.execute are buffered, ending the
+            # transaction does not affect them
+            await session.commit()
+        return result
+
+    async def scalar(self, statement, *args, **kwargs):
+        result = await self.execute(statement, *args, **kwargs)
+        return result.scalar()
+
+    async def scalars(self, statement, *args, **kwargs):
+        result = await self.execute(statement, *args, **kwargs)
+        return result.scalars()
+
+    async def commit(self):
+        self._writing = False
+        if self._session is not None:
+            await self._session.commit()
+
+    async def rollback(self):
+        self._writing = False
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self):
+        self._writing = False
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
 
 class DatabaseMiddleware(BaseMiddleware):
     def __init__(self, session_pool):
         self.session_pool = session_pool
+        self.counters = defaultdict(lambda: {"updates": 0, "sessions": 0, "queries": 0})
 
     async def __call__(
         self,
@@ -14,7 +80,35 @@ class DatabaseMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any]
     ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        counters = self.counters[name]
+        counters["updates"] += 1
 
-        async with self.session_pool() as session:
-            data["session"] = session
+        session = LazySession(self.session_pool, counters)
+        data["session"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+
+    def stats(self) -> dict:
+        return {name: dict(counters) for name, counters in self.counters.items()}
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        token = query_context.set(f"bot:{name}")
+        started = time.perf_counter()
+        try:
             return await handler(event, data)
+        finally:
+            query_context.reset(token)
+            BOT_HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
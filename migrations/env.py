@@ -0,0 +1,61 @@
+import asyncio
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy import make_url, pool
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from models import Model
+
+load_dotenv()
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Model.metadata
+DB_URL = os.getenv("DB_URL")
+
+
+def include_object_for(dialect: str):
+    def include_object(object, name, type_, reflected, compare_to):
+        # The SQLite search index is an FTS5 table with its shadow tables, made by raw DDL
+        if type_ == "table" and name.startswith("products_fts"):
+            return False
+        # Indexes limited with ddl_if(dialect=...) only exist on that database
+        ddl_if = getattr(object, "_ddl_if", None)
+        if type_ == "index" and ddl_if is not None and ddl_if.dialect is not None:
+            dialects = (ddl_if.dialect,) if isinstance(ddl_if.dialect, str) else ddl_if.dialect
+            return dialect in dialects
+        return True
+
+    return include_object
+
+
+def run_migrations_offline():
+    context.configure(url=DB_URL, target_metadata=target_metadata, literal_binds=True,
+                      include_object=include_object_for(make_url(DB_URL).get_dialect().name))
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection):
+    context.configure(connection=connection, target_metadata=target_metadata,
+                      include_object=include_object_for(connection.dialect.name))
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_migrations_online():
+    engine = create_async_engine(DB_URL, poolclass=pool.NullPool)
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_migrations_online())
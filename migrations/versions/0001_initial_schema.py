@@ -0,0 +1,52 @@
+"""initial schema
+
+The tables as database.create_tables made them. Existing databases are
+stamped with this revision instead of running it:
+
+    alembic stamp 0001
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'products',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('title', sa.String(64), nullable=False),
+        sa.Column('description', sa.String(512), nullable=False),
+        sa.Column('category', sa.Enum('games', 'subs', 'accounts', name='categories'), nullable=False),
+        sa.Column('price', sa.Integer(), nullable=False),
+        sa.Column('image', sa.String(), nullable=False),
+        sa.CheckConstraint('price > 0', name='checl_price_positive'),
+    )
+    op.create_table(
+        'keys',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('item', sa.String(), nullable=False, unique=True),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id', ondelete='CASCADE'), nullable=False),
+    )
+    op.create_table(
+        'payments',
+        sa.Column('uuid', sa.Uuid(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), nullable=False),
+        sa.Column('date', sa.DateTime(), server_default=sa.text("TIMEZONE('utc', now())"), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('payments')
+    op.drop_table('keys')
+    op.drop_table('products')
+    sa.Enum(name='categories').drop(op.get_bind(), checkfirst=True)
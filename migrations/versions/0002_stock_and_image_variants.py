@@ -0,0 +1,54 @@
+"""products.stock, image_webp and thumbnail
+
+Databases made by database.create_tables after these columns were added
+already have some of them, only the missing ones are created. A new stock
+column is filled from the keys that are left.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if context.is_offline_mode():
+        # Generated SQL targets the baseline schema, there is nothing to inspect
+        columns, constraints = set(), set()
+    else:
+        inspector = sa.inspect(op.get_bind())
+        columns = {column['name'] for column in inspector.get_columns('products')}
+        constraints = {constraint['name'] for constraint in inspector.get_check_constraints('products')}
+
+    # SQLite can not add a constraint in place, batch mode rebuilds the table there
+    with op.batch_alter_table('products') as batch:
+        if 'stock' not in columns:
+            batch.add_column(sa.Column('stock', sa.Integer(), server_default=sa.text('0'), nullable=False))
+        if 'image_webp' not in columns:
+            batch.add_column(sa.Column('image_webp', sa.String(), nullable=True))
+        if 'thumbnail' not in columns:
+            batch.add_column(sa.Column('thumbnail', sa.String(), nullable=True))
+
+    if 'stock' not in columns:
+        op.execute(
+            "UPDATE products SET stock = "
+            "(SELECT count(*) FROM keys WHERE keys.product_id = products.id)"
+        )
+
+    if 'check_stock_non_negative' not in constraints:
+        with op.batch_alter_table('products') as batch:
+            batch.create_check_constraint('check_stock_non_negative', 'stock >= 0')
+
+
+def downgrade():
+    with op.batch_alter_table('products') as batch:
+        batch.drop_constraint('check_stock_non_negative', type_='check')
+        batch.drop_column('thumbnail')
+        batch.drop_column('image_webp')
+        batch.drop_column('stock')
@@ -0,0 +1,33 @@
+"""indexes for the listing, key dispensing and payment queries
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_products_category_id', 'products', ['category', 'id']),
+    ('ix_keys_product_id_id', 'keys', ['product_id', 'id']),
+    ('ix_payments_user_id', 'payments', ['user_id']),
+    ('ix_payments_status', 'payments', ['status']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY keeps the tables writable while Postgres builds the
+    # indexes, it is not allowed inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
@@ -3,7 +3,7 @@ import enum
 from typing import Annotated
 
 from pydantic import UUID1
-from sqlalchemy import ForeignKey, String, CheckConstraint, text
+from sqlalchemy import DDL, ForeignKey, String, CheckConstraint, Index, event, func, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 intpk = Annotated[int, mapped_column(primary_key=True)]
@@ -28,20 +28,66 @@ class ProductsModel(Model):
     description: Mapped[str] = mapped_column(String(512))
     category: Mapped[Categories]
     price: Mapped[int] = mapped_column(nullable=False)
+    stock: Mapped[int] = mapped_column(default=0, server_default=text("0"))
     keys: Mapped[list['KeysModel']] = relationship(back_populates="product")
     payments: Mapped[list['PaymentsModel']] = relationship(back_populates='product')
     image: Mapped[str]
+    image_webp: Mapped[str | None]
+    thumbnail: Mapped[str | None]
 
     __table_args__ = (
         CheckConstraint("price > 0", name="checl_price_positive"),
+        CheckConstraint("stock >= 0", name="check_stock_non_negative"),
+        # Category listings filter on category and page by id
+        Index("ix_products_category_id", "category", "id"),
     )
 
     def as_dict_with_remainder(self):
         res = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        res['remainder'] = 0
+        res['remainder'] = self.stock
         return res
 
 
+# Search matches title and description. On Postgres the expression below is
+# indexed with GIN and queries must use it verbatim, SQLite gets an FTS5 table
+# kept in sync by triggers.
+SEARCH_CONFIG = "russian"
+search_vector = func.to_tsvector(
+    text(f"'{SEARCH_CONFIG}'"),
+    ProductsModel.__table__.c.title.op("||")(text("' '")).op("||")(ProductsModel.__table__.c.description)
+)
+
+Index("ix_products_search", search_vector, postgresql_using="gin").ddl_if(dialect="postgresql")
+Index(
+    "ix_products_title_trgm",
+    ProductsModel.title,
+    postgresql_using="gin",
+    postgresql_ops={"title": "gin_trgm_ops"}
+).ddl_if(dialect="postgresql")
+
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts "
+    "USING fts5(title, description, content='products', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO products_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO products_fts(products_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    # Stock updates do not touch the text, only title and description edits reindex
+    "CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF title, description ON products BEGIN "
+    "INSERT INTO products_fts(products_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO products_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+)
+
+event.listen(Model.metadata, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(ProductsModel.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(ProductsModel.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS products_fts").execute_if(dialect="sqlite"))
+
+
 class KeysModel(Model):
     __tablename__ = "keys"
 
@@ -50,6 +96,11 @@ class KeysModel(Model):
     product_id: Mapped[int] = mapped_column(ForeignKey('products.id', ondelete="CASCADE"))
     product: Mapped[list['ProductsModel']] = relationship(back_populates="keys")
 
+    __table_args__ = (
+        # select_key takes the lowest ids of one product
+        Index("ix_keys_product_id_id", "product_id", "id"),
+    )
+
 
 class PaymentsModel(Model):
     __tablename__ = "payments"
@@ -61,3 +112,8 @@ class PaymentsModel(Model):
     date: Mapped[created_at]
     status: Mapped[str]
 
+    __table_args__ = (
+        Index("ix_payments_user_id", "user_id"),
+        Index("ix_payments_status", "status"),
+    )
+
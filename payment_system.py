@@ -1,12 +1,23 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import logging
 import os
+import time
 import uuid
+from typing import Protocol, Callable, Awaitable, NamedTuple
 
+import orjson
 from dotenv import load_dotenv
+from fastapi import HTTPException
+from redis.asyncio import Redis
 from yoomoney import Client
 from yoomoney import Quickpay
 
-from queries import payment_save
-from schemas import ProductsGet
+from cache import invalidate_touched
+from queries import payment_save, select_key, get_payment_status
+from schemas import ProductsGet, KeysGet
 
 load_dotenv()
 
@@ -17,11 +28,131 @@ redirect_uri = "https://yoomoney.ru"
 
 token = os.getenv('YOO_TOKEN')
 client = Client(token)
+notification_secret = os.getenv("YOO_NOTIFICATION_SECRET", "")
 
+PENDING_KEY = "payments:pending"
+PENDING_DATA_KEY = "payments:pending:data"
+DELIVERING_KEY = "payments:delivering"
+WAKE_KEY = "payments:wake"
+WAKE_TIMEOUT = 4
+POLL_INTERVAL = float(os.getenv("PAYMENTS_POLL_INTERVAL", 10))
+MAX_BACKOFF = float(os.getenv("PAYMENTS_MAX_BACKOFF", 600))
+POLL_BATCH_SIZE = int(os.getenv("PAYMENTS_POLL_BATCH_SIZE", 50))
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENTS_TIMEOUT", 24 * 3600))
+DELIVERY_LEASE = float(os.getenv("PAYMENTS_DELIVERY_LEASE", 300))
+# Operation history reports the amount credited after the YooMoney fee
+FEE_TOLERANCE = float(os.getenv("PAYMENTS_FEE_TOLERANCE", 0.03))
 
-async def make_payment(product: ProductsGet, user_id):
+logger = logging.getLogger('payments')
+
+
+class ProviderOperation(NamedTuple):
+    status: str
+    amount: float
+
+
+class PaymentProvider(Protocol):
+    async def statuses(self, labels: list[str], since: datetime.datetime) -> dict[str, ProviderOperation]:
+        ...
+
+
+class YooMoneyProvider:
+    def __init__(self, yoomoney_client: Client = client, records: int = 100):
+        self.client = yoomoney_client
+        self.records = records
+
+    def _statuses(self, labels: list[str], since: datetime.datetime) -> dict[str, ProviderOperation]:
+        # One history request covers the whole batch instead of a request per label
+        wanted = set(labels)
+        found = {}
+        start_record = None
+        while True:
+            history = self.client.operation_history(type="deposition", from_date=since,
+                                                    start_record=start_record, records=self.records)
+            for operation in history.operations:
+                if operation.label in wanted:
+                    found[operation.label] = ProviderOperation(operation.status, operation.amount or 0)
+            start_record = history.next_record
+            if not start_record or len(found) == len(wanted):
+                return found
+
+    async def statuses(self, labels: list[str], since: datetime.datetime) -> dict[str, ProviderOperation]:
+        # The yoomoney client is synchronous, keep it off the event loop
+        return await asyncio.to_thread(self._statuses, labels, since)
+
+
+_CLAIM_DELIVERY = """
+if redis.call('zrem', KEYS[1], ARGV[1]) == 1 then
+    redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# A notification can confirm the payment while the reconciler waits for the
+# provider, its stale "pending" copy must not overwrite that
+_RESCHEDULE_PENDING = """
+local raw = redis.call('hget', KEYS[2], ARGV[1])
+if not raw or cjson.decode(raw)['status'] ~= 'pending' then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+_FORGET_PENDING = """
+local raw = redis.call('hget', KEYS[2], ARGV[1])
+if raw and cjson.decode(raw)['status'] ~= 'pending' then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+def notification_signature(fields: dict, secret: str = notification_secret) -> str:
+    parts = [
+        fields.get("notification_type", ""),
+        fields.get("operation_id", ""),
+        fields.get("amount", ""),
+        fields.get("currency", ""),
+        fields.get("datetime", ""),
+        fields.get("sender", ""),
+        fields.get("codepro", ""),
+        secret,
+        fields.get("label", ""),
+    ]
+    return hashlib.sha1("&".join(parts).encode()).hexdigest()
+
+
+def verify_notification(fields: dict, secret: str = notification_secret) -> bool:
+    if not secret:
+        return False
+    return hmac.compare_digest(notification_signature(fields, secret), fields.get("sha1_hash", ""))
+
+
+async def track_payment(redis: Redis, label, user_id: int, product_id: int, price: int):
+    data = {
+        "user_id": user_id,
+        "product_id": product_id,
+        "price": price,
+        "created": time.time(),
+        "attempts": 0,
+        "status": "pending",
+    }
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(PENDING_DATA_KEY, str(label), orjson.dumps(data))
+        pipe.zadd(PENDING_KEY, {str(label): time.time() + POLL_INTERVAL})
+        await pipe.execute()
+
+
+async def make_payment(product: ProductsGet, user_id, redis: Redis):
     label = uuid.uuid1()
-    quickpay = Quickpay(
+    # Quickpay posts the form to YooMoney from its constructor with a blocking client
+    quickpay = await asyncio.to_thread(
+                Quickpay,
                 receiver=os.getenv("RECIVER"),
                 quickpay_form="shop",
                 targets=f"{product.title}",
@@ -31,6 +162,7 @@ async def make_payment(product: ProductsGet, user_id):
                 label=label,
 
                 )
+    await track_payment(redis, label, user_id, product.id, product.price)
 
     return {
         "URL": quickpay.redirected_url,
@@ -39,18 +171,188 @@ async def make_payment(product: ProductsGet, user_id):
     }
 
 
-async def check_status(label, user_id, product_id, session):
-    payment_rep = {
-        "uuid": label,
-        "user_id": user_id,
-        "product_id": product_id,
-    }
-    history = client.operation_history(label=label)
-    for operation in history.operations:
-        payment_rep['status'] = operation.status
-        await payment_save(payment_rep, session)
-        return True
+async def confirm_payment(redis: Redis, session, label: str, paid_amount: float) -> bool:
+    # Called from the YooMoney notification, the delivery itself is done by
+    # the reconciler, which is woken up right away
+    raw = await redis.hget(PENDING_DATA_KEY, label)
+    if raw is None:
+        return False
+    payment = orjson.loads(raw)
+    if paid_amount < payment["price"] * (1 - FEE_TOLERANCE):
+        logger.warning("Payment %s is %s, expected %s", label, paid_amount, payment["price"])
+        return False
+    await payment_save({
+        "uuid": uuid.UUID(label),
+        "user_id": payment["user_id"],
+        "product_id": payment["product_id"],
+        "status": "success",
+    }, session)
+    payment["status"] = "success"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(PENDING_DATA_KEY, label, orjson.dumps(payment))
+        pipe.zadd(PENDING_KEY, {label: 0}, xx=True)
+        pipe.rpush(WAKE_KEY, label)
+        await pipe.execute()
+    return True
+
+
+class PaymentReconciler:
+    def __init__(
+            self,
+            redis: Redis,
+            session_pool,
+            provider: PaymentProvider,
+            notify: Callable[[int, int, list[KeysGet]], Awaitable[None]],
+    ):
+        self.redis = redis
+        self.session_pool = session_pool
+        self.provider = provider
+        self.notify = notify
+        self.failures = 0
 
+    async def run(self):
+        while True:
+            try:
+                delay = await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Payment reconciliation failed")
+                delay = POLL_INTERVAL
+            await self.wait(delay)
 
+    async def wait(self, delay: float):
+        # Sleep until the next poll, or until a notification confirms a payment
+        deadline = time.monotonic() + delay
+        while (remaining := deadline - time.monotonic()) > 0:
+            if await self.redis.blpop([WAKE_KEY], timeout=min(remaining, WAKE_TIMEOUT)):
+                await self.redis.delete(WAKE_KEY)
+                return
+
+    async def poll_once(self) -> float:
+        now = time.time()
+        await self.requeue_stale_deliveries(now)
+        labels = [label.decode() for label in
+                  await self.redis.zrangebyscore(PENDING_KEY, 0, now, start=0, num=POLL_BATCH_SIZE)]
+        if not labels:
+            return POLL_INTERVAL
+        payments = {label: orjson.loads(raw) for label, raw in
+                    zip(labels, await self.redis.hmget(PENDING_DATA_KEY, labels)) if raw}
+        if orphans := [label for label in labels if label not in payments]:
+            await self.redis.zrem(PENDING_KEY, *orphans)
+
+        statuses = {}
+        backoff = None
+        unconfirmed = [label for label, payment in payments.items() if payment["status"] != "success"]
+        if unconfirmed:
+            statuses = await self._provider_statuses(unconfirmed, payments)
+            if statuses is None:
+                # Payments already confirmed by a notification are still delivered
+                self.failures += 1
+                backoff = min(POLL_INTERVAL * 2 ** self.failures, MAX_BACKOFF)
+                logger.warning("Payment provider unavailable, next poll in %.0fs", backoff)
+                payments = {label: payment for label, payment in payments.items() if label not in unconfirmed}
+                statuses = {}
+            else:
+                self.failures = 0
+
+        for label, payment in payments.items():
+            operation = statuses.get(label)
+            if operation is not None and operation.status == "success" and payment["status"] != "success":
+                if operation.amount < payment["price"] * (1 - FEE_TOLERANCE):
+                    logger.warning("Payment %s is %s, expected %s", label, operation.amount, payment["price"])
+                    await self.forget(label)
+                    continue
+                payment["status"] = "success"
+            if payment["status"] == "success":
+                await self.complete(label, payment)
+            elif now - payment["created"] > PAYMENT_TIMEOUT:
+                await self.forget(label)
+            else:
+                await self.reschedule(label, payment, now)
+        if backoff is not None:
+            return backoff
+        return 0 if len(labels) == POLL_BATCH_SIZE else POLL_INTERVAL
+
+    async def _provider_statuses(self, labels: list[str], payments: dict) -> dict[str, ProviderOperation] | None:
+        since = datetime.datetime.fromtimestamp(min(payments[label]["created"] for label in labels) - 60)
+        try:
+            return await self.provider.statuses(labels, since)
+        except Exception:
+            logger.exception("Payment provider request failed")
+            return None
+
+    async def reschedule(self, label: str, payment: dict, now: float):
+        payment["attempts"] += 1
+        delay = min(POLL_INTERVAL * 2 ** payment["attempts"], MAX_BACKOFF)
+        await self.redis.eval(_RESCHEDULE_PENDING, 2, PENDING_KEY, PENDING_DATA_KEY, label,
+                              orjson.dumps(payment), now + delay)
+
+    async def forget(self, label: str):
+        # Only payments that are still unconfirmed are dropped
+        await self.redis.eval(_FORGET_PENDING, 2, PENDING_KEY, PENDING_DATA_KEY, label)
+
+    async def requeue_stale_deliveries(self, now: float):
+        # A worker that died while delivering leaves its label behind
+        if stale := await self.redis.zrangebyscore(DELIVERING_KEY, 0, now):
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(DELIVERING_KEY, *stale)
+                pipe.zadd(PENDING_KEY, {label: now for label in stale}, nx=True)
+                await pipe.execute()
+
+    async def complete(self, label: str, payment: dict) -> bool:
+        # Moving the label to the delivering set is the claim, only one worker
+        # gets to deliver. The payment data stays until delivery succeeded.
+        if not await self.redis.eval(_CLAIM_DELIVERY, 2, PENDING_KEY, DELIVERING_KEY, label,
+                                     time.time() + DELIVERY_LEASE):
+            return False
+        try:
+            keys = await self.deliver(label, payment)
+            await self.notify(payment["user_id"], payment["product_id"], keys)
+        except Exception:
+            logger.exception("Delivery of payment %s failed, retrying later", label)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(DELIVERING_KEY, label)
+                pipe.zadd(PENDING_KEY, {label: time.time() + POLL_INTERVAL})
+                await pipe.execute()
+            return False
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(DELIVERING_KEY, label)
+            pipe.hdel(PENDING_DATA_KEY, label)
+            await pipe.execute()
+        return True
 
+    async def deliver(self, label: str, payment: dict) -> list[KeysGet]:
+        # Keys taken by an earlier attempt are kept with the payment, a retry
+        # only sends them again
+        if "keys" in payment:
+            return [KeysGet(item=item) for item in payment["keys"]]
+        async with self.session_pool() as session:
+            await payment_save({
+                "uuid": uuid.UUID(label),
+                "user_id": payment["user_id"],
+                "product_id": payment["product_id"],
+                "status": "success",
+            }, session)
+            try:
+                keys = await select_key(payment["product_id"], session)
+            except HTTPException:
+                keys = []
+            await invalidate_touched(self.redis, session)
+        payment["status"] = "success"
+        payment["keys"] = [key.item for key in keys]
+        await self.redis.hset(PENDING_DATA_KEY, label, orjson.dumps(payment))
+        return keys
 
+    async def check(self, label: str) -> bool:
+        # Local lookup only, confirmations arrive through the notification
+        # endpoint and the background poll
+        raw = await self.redis.hget(PENDING_DATA_KEY, label)
+        if raw is not None:
+            payment = orjson.loads(raw)
+            if payment["status"] == "success":
+                await self.complete(label, payment)
+                return True
+            return False
+        async with self.session_pool() as session:
+            return await get_payment_status(uuid.UUID(label), session) == "success"
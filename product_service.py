@@ -1,86 +1,187 @@
-import json
+import base64
+import hashlib
+import time
+from dataclasses import dataclass
+from functools import partial
 
+import orjson
 from redis.asyncio import Redis
-from sqlalchemy import select, func, asc
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from models import ProductsModel, KeysModel
-from schemas import ProductsGet
+from cache import PRODUCTS_CACHE_TTL, LocalCache, get_version, local_cache, single_flight, acquire_fill_lock, \
+    release_fill_lock, wait_for_fill, should_refresh_early
+from metrics import CACHE_REQUESTS
+from queries import select_products, select_all_products, count_products, search_products, count_search, \
+    search_terms
+
+
+def encode_cursor(product_id: int) -> str:
+    return base64.urlsafe_b64encode(str(product_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def next_cursor(items: list, limit: int) -> str | None:
+    if len(items) < limit or not items:
+        return None
+    last = items[-1]
+    return encode_cursor(last['id'])
+
+
+PAGE_FIELDS = ("body", "next", "total")
+
+
+@dataclass(slots=True)
+class Page:
+    body: bytes
+    next_cursor: str | None = None
+    total: int = 0
+
+    @classmethod
+    def from_hash(cls, body: bytes, cursor: bytes | None, total: bytes | None) -> 'Page':
+        return cls(body, cursor.decode() if cursor else None, int(total or 0))
 
 
 class ProductService:
-    def __init__(self, session: AsyncSession, redis: Redis):
-        self.session = session
+    def __init__(self, redis: Redis, session_pool: async_sessionmaker, cache: LocalCache = local_cache):
         self.redis = redis
+        self.session_pool = session_pool
+        self.local_cache = cache
+
+    async def _query(self, query, *args):
+        # Loaders run in the single-flight task shared by every waiter, so they
+        # take their own session instead of the one of the first caller
+        async with self.session_pool() as session:
+            return await query(session, *args)
+
+    async def _cached(self, key: str, category: str | None, limit: int, loader,
+                      count_name: str | None = None, counter=None) -> Page:
+        if (cached := self.local_cache.get(key)) is not None:
+            CACHE_REQUESTS.labels("l1", "hit").inc()
+            return cached
+        CACHE_REQUESTS.labels("l1", "miss").inc()
+        generation = self.local_cache.generation
+
+        version = await get_version(self.redis, category)
+        cache_key = f"{key}:v{version}"
+        count_key = f"products:count:{count_name or category or 'all'}:v{version}"
+        counter = counter or partial(self._query, count_products, category)
+        fill = partial(self._fill, cache_key, count_key, counter, limit, loader)
+        result = await single_flight.do(cache_key, lambda: self._load(cache_key, fill))
+
+        self.local_cache.set(key, result, category, generation)
+        return result
+
+    async def _load(self, cache_key: str, fill) -> Page:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(cache_key, *PAGE_FIELDS, "delta")
+            pipe.pttl(cache_key)
+            (*fields, delta), ttl = await pipe.execute()
+
+        CACHE_REQUESTS.labels("redis", "miss" if fields[0] is None else "hit").inc()
+        if fields[0] is not None:
+            page = Page.from_hash(*fields)
+            if not should_refresh_early(float(delta or 0), ttl):
+                return page
+            # Only the lock holder rebuilds ahead of expiry, everyone else
+            # keeps serving the current value
+            if token := await acquire_fill_lock(self.redis, cache_key):
+                try:
+                    return await fill()
+                finally:
+                    await release_fill_lock(self.redis, cache_key, token)
+            return page
+
+        if token := await acquire_fill_lock(self.redis, cache_key):
+            try:
+                return await fill()
+            finally:
+                await release_fill_lock(self.redis, cache_key, token)
+        if fields := await wait_for_fill(self.redis, cache_key, PAGE_FIELDS):
+            return Page.from_hash(*fields)
+        return await fill()
+
+    async def _fill(self, cache_key: str, count_key: str, counter, limit: int, loader) -> Page:
+        started = time.perf_counter()
+        result = await loader()
+        total = await self._count(count_key, counter)
+        delta = time.perf_counter() - started
+        page = Page(orjson.dumps(result), next_cursor(result, limit), total)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(cache_key, mapping={
+                "body": page.body,
+                "next": page.next_cursor or "",
+                "total": page.total,
+                "delta": delta,
+            })
+            pipe.expire(cache_key, PRODUCTS_CACHE_TTL)
+            await pipe.execute()
+        return page
+
+    async def _count(self, count_key: str, counter) -> int:
+        # Counts share the listing version, so any product, key or sale
+        # event that bumps it also retires the stale count
+        if (cached := await self.redis.get(count_key)) is not None:
+            return int(cached)
+        total = await counter()
+        await self.redis.set(count_key, total, ex=PRODUCTS_CACHE_TTL)
+        return total
 
     async def get_products(
             self,
             category: str,
             limit: int = 3,
-            offset: int = 0
-    ) -> list[ProductsGet]:
-        cache_key = f"products:{category}:{limit}:{offset}"
-
-        if cached := await self.redis.get(cache_key):
-            return json.loads(cached)
-
-        result = await self._fetch_from_db(category, limit, offset)
+            offset: int = 0,
+            after: int | None = None
+    ) -> Page:
+        page = f"a{after}" if after is not None else offset
+        return await self._cached(
+            f"products:{category}:{limit}:{page}",
+            category,
+            limit,
+            lambda: self._fetch_from_db(category, limit, offset, after)
+        )
 
-        result_json = json.dumps([item.model_dump() for item in result])
-        await self.redis.setex(cache_key, 300, result_json)
-        return result
+    async def _fetch_from_db(self, category: str, limit: int, offset: int, after: int | None = None) -> list[dict]:
+        return await self._query(select_products, category, limit, offset, after)
 
-    async def _fetch_from_db(self, category: str, limit: int, offset: int):
-        query = (
-            select(ProductsModel, func.count(KeysModel.id))
-            .join(KeysModel, ProductsModel.id == KeysModel.product_id)
-            .where(ProductsModel.category == category)
-            .group_by(ProductsModel.id)
-            .having(func.count(KeysModel.id) > 0)
-            .order_by(asc(ProductsModel.id))
-            .offset(offset)
-            .limit(limit)
-        )
-        result = await self.session.execute(query)
-        products = result.all()
-        res = []
-        for product in products:
-            model_dict = product[0].as_dict_with_remainder()
-            model_dict['remainder'] = product[1]
-            res.append(model_dict)
-        products_schema = [ProductsGet.model_validate(product) for product in res]
-        return products_schema
-
-    async def get_all_products(self, limit: int = 3, offset: int = 0) -> list[ProductsGet]:
-        cache_key = f'products:{limit}:{offset}'
-
-        if cached := await self.redis.get(cache_key):
-            return json.loads(cached)
-
-        db_result = await self.fetch_all_products(limit, offset)
-
-        serialized = json.dumps([item.dict() for item in db_result])
-        await self.redis.setex(cache_key, 300, serialized)
-        return db_result
-
-    async def fetch_all_products(self, limit: int, offset: int) -> list[ProductsGet]:
-        query = (
-            select(ProductsModel, func.count(KeysModel.id))
-            .join(KeysModel, ProductsModel.id == KeysModel.product_id, isouter=True)
-            .group_by(ProductsModel.id)
-            .order_by(asc(ProductsModel.id))
-            .offset(offset)
-            .limit(limit)
+    async def get_all_products(
+            self,
+            limit: int = 3,
+            offset: int = 0,
+            after: int | None = None
+    ) -> Page:
+        page = f"a{after}" if after is not None else offset
+        return await self._cached(
+            f"products:{limit}:{page}",
+            None,
+            limit,
+            lambda: self.fetch_all_products(limit, offset, after)
         )
 
-        result = await self.session.execute(query)
-        products = result.all()
-        res = []
-        for product in products:
-            print(product)
-            model_dict = product[0].as_dict_with_remainder()
-            model_dict['remainder'] = product[1]
-            res.append(model_dict)
-
-        products_schema = [ProductsGet.model_validate(product) for product in res]
-        return products_schema
+    async def fetch_all_products(self, limit: int, offset: int, after: int | None = None) -> list[dict]:
+        return await self._query(select_all_products, limit, offset, after)
+
+    async def search(self, query: str, limit: int = 10, offset: int = 0) -> Page:
+        # Searches live under the global version, any product, key or sale
+        # event retires them together with the listings
+        terms = search_terms(query)
+        if not terms:
+            return Page(b"[]")
+        digest = hashlib.sha1(" ".join(terms).encode()).hexdigest()
+        page = await self._cached(
+            f"products:search:{digest}:{limit}:{offset}",
+            None,
+            limit,
+            lambda: self._query(search_products, terms, limit, offset),
+            count_name=f"search:{digest}",
+            counter=partial(self._query, count_search, terms)
+        )
+        # Results are ordered by relevance, an id cursor means nothing here
+        return Page(page.body, None, page.total)
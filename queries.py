@@ -1,7 +1,12 @@
+import re
+
 from fastapi import HTTPException
-from sqlalchemy import select, func, asc
+from sqlalchemy import select, func, asc, update, delete, type_coerce, String, column, literal_column, or_, table, \
+    text
+from sqlalchemy.dialects import postgresql, sqlite
 
-from models import ProductsModel, KeysModel, PaymentsModel
+from cache import touch_categories
+from models import ProductsModel, KeysModel, PaymentsModel, SEARCH_CONFIG, search_vector
 from schemas import ProductsGet, KeysGet, PaymentsPost
 
 
@@ -10,59 +15,136 @@ async def add_product(product, session):
     new_product = ProductsModel(**product_dict)
     session.add(new_product)
     await session.commit()
+    touch_categories(session, new_product.category)
     return {'ok': True}
 
 
-async def select_products(session, category, limit, offset) -> list[ProductsGet]:
+# Listing columns in ProductsGet field order. Rows are mapped straight to
+# response dicts, no ORM entities are loaded into the identity map.
+PRODUCT_COLUMNS = (
+    ProductsModel.title,
+    ProductsModel.description,
+    ProductsModel.price,
+    type_coerce(ProductsModel.category, String).label('category'),
+    ProductsModel.image,
+    ProductsModel.image_webp,
+    ProductsModel.thumbnail,
+    ProductsModel.id,
+    ProductsModel.stock.label('remainder'),
+)
+
+
+def listing_query(limit: int, offset: int = 0, after: int | None = None):
     query = (
-        select(ProductsModel, func.count(KeysModel.id))
-        .join(KeysModel, ProductsModel.id == KeysModel.product_id)
-        .where(ProductsModel.category == category)
-        .group_by(ProductsModel.id)
-        .having(func.count(KeysModel.id) > 0)
+        select(*PRODUCT_COLUMNS)
         .order_by(asc(ProductsModel.id))
-        .offset(offset)
         .limit(limit)
     )
+    if after is not None:
+        return query.where(ProductsModel.id > after)
+    return query.offset(offset)
+
+
+async def select_products(session, category, limit, offset, after: int | None = None) -> list[dict]:
+    query = listing_query(limit, offset, after).where(
+        ProductsModel.category == category,
+        ProductsModel.stock > 0
+    )
     result = await session.execute(query)
-    products = result.all()
-    res = []
-    for product in products:
-        model_dict = product[0].as_dict_with_remainder()
-        model_dict['remainder'] = product[1]
-        res.append(model_dict)
-    products_schema = [ProductsGet.model_validate(product) for product in res]
-    return products_schema
+    return [row._asdict() for row in result]
+
+
+async def select_all_products(session, limit, offset, after: int | None = None) -> list[dict]:
+    result = await session.execute(listing_query(limit, offset, after))
+    return [row._asdict() for row in result]
+
+
+async def count_products(session, category: str | None = None) -> int:
+    # Category listings only show products in stock, the full listing shows all
+    query = select(func.count(ProductsModel.id))
+    if category is not None:
+        query = query.where(ProductsModel.category == category, ProductsModel.stock > 0)
+    result = await session.execute(query)
+    return result.scalar_one()
+
 
+SEARCH_TOKEN = re.compile(r"\w+")
+MAX_SEARCH_TERMS = 8
 
-async def select_all_products(session, limit, offset) -> list[ProductsGet]:
+products_fts = table("products_fts", column("rowid"), column("rank"))
+
+
+def search_terms(query: str) -> list[str]:
+    # Only word characters reach the engines, user input can not break the
+    # tsquery or FTS5 query syntax
+    return SEARCH_TOKEN.findall(query.lower())[:MAX_SEARCH_TERMS]
+
+
+def _search_query(session, terms: list[str], *columns):
+    # Every term must match as a prefix, so results show up while typing. On
+    # Postgres a trigram match on the title also catches typos
+    query = select(*columns).select_from(ProductsModel)
+    if session.get_bind().dialect.name == 'sqlite':
+        match = " ".join(f'"{term}"*' for term in terms)
+        query = (
+            query.join(products_fts, products_fts.c.rowid == ProductsModel.id)
+            .where(literal_column("products_fts").op("MATCH")(match))
+        )
+        return query, products_fts.c.rank
+    ts_query = func.to_tsquery(text(f"'{SEARCH_CONFIG}'"), " & ".join(f"{term}:*" for term in terms))
+    phrase = " ".join(terms)
+    relevance = func.ts_rank_cd(search_vector, ts_query) + func.similarity(ProductsModel.title, phrase)
+    query = query.where(or_(search_vector.op("@@")(ts_query), ProductsModel.title.op("%")(phrase)))
+    return query, relevance.desc()
+
+
+async def search_products(session, terms: list[str], limit: int, offset: int) -> list[dict]:
+    query, relevance = _search_query(session, terms, *PRODUCT_COLUMNS)
     query = (
-        select(ProductsModel, func.count(KeysModel.id))
-        .join(KeysModel, ProductsModel.id == KeysModel.product_id, isouter=True)
-        .group_by(ProductsModel.id)
-        .order_by(asc(ProductsModel.id))
+        query
+        .order_by((ProductsModel.stock > 0).desc(), relevance, ProductsModel.stock.desc(), asc(ProductsModel.id))
         .offset(offset)
         .limit(limit)
     )
+    result = await session.execute(query)
+    return [row._asdict() for row in result]
+
 
+async def count_search(session, terms: list[str]) -> int:
+    query, _ = _search_query(session, terms, func.count(ProductsModel.id))
     result = await session.execute(query)
-    products = result.all()
-    res = []
-    for product in products:
-        print(product)
-        model_dict = product[0].as_dict_with_remainder()
-        model_dict['remainder'] = product[1]
-        res.append(model_dict)
+    return result.scalar_one()
 
-    products_schema = [ProductsGet.model_validate(product) for product in res]
-    return products_schema
 
+async def change_stock(product_id: int, delta: int, session):
+    query = (
+        update(ProductsModel)
+        .where(ProductsModel.id == product_id)
+        .values(stock=ProductsModel.stock + delta)
+        .returning(ProductsModel.category)
+    )
+    result = await session.execute(query)
+    category = result.scalar_one_or_none()
+    touch_categories(session, category)
+    return category
 
-async def total_rows(model, session):
-    row_count = func.count(ProductsModel.id)
-    rows = await session.execute(row_count)
-    rows = rows.scalars().one()
-    return rows
+
+async def reconcile_stock(session) -> list[int]:
+    counted = (
+        select(func.count(KeysModel.id))
+        .where(KeysModel.product_id == ProductsModel.id)
+        .scalar_subquery()
+    )
+    query = (
+        update(ProductsModel)
+        .where(ProductsModel.stock != counted)
+        .values(stock=counted)
+        .returning(ProductsModel.id)
+    )
+    result = await session.execute(query)
+    fixed = list(result.scalars().all())
+    await session.commit()
+    return fixed
 
 
 async def add_key(key, session):
@@ -70,23 +152,91 @@ async def add_key(key, session):
     new_key = KeysModel(**key_dict)
     try:
         session.add(new_key)
+        await change_stock(new_key.product_id, 1, session)
         await session.commit()
         return {'ok': True}
     except Exception as e:
+        await session.rollback()
         raise HTTPException(status_code=409, detail=str(e))
 
 
-async def select_key(product_id: int, session) -> list[KeysGet]:
-    query = select(KeysModel).where(KeysModel.product_id == product_id)
-    result = await session.execute(query)
-    res = result.scalars().first()
-    if res:
-        await session.delete(res)
+KEYS_BATCH_SIZE = 5000
+MAX_KEY_LENGTH = 256
+
+
+def is_valid_key(item: str) -> bool:
+    return len(item) <= MAX_KEY_LENGTH and item.isprintable()
+
+
+def _dialect_insert(session):
+    if session.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert
+    return postgresql.insert
+
+
+async def import_keys(chunks, product_id: int, session) -> dict:
+    report = {'inserted': 0, 'duplicates': 0, 'invalid': 0}
+    insert = _dialect_insert(session)
+    try:
+        async for chunk in chunks:
+            items = []
+            for line in chunk:
+                try:
+                    item = line.decode('utf-8').strip()
+                except UnicodeDecodeError:
+                    report['invalid'] += 1
+                    continue
+                if not item:
+                    continue
+                if not is_valid_key(item):
+                    report['invalid'] += 1
+                    continue
+                items.append(item)
+            for start in range(0, len(items), KEYS_BATCH_SIZE):
+                batch = items[start:start + KEYS_BATCH_SIZE]
+                query = (
+                    insert(KeysModel)
+                    .values([{'item': item, 'product_id': product_id} for item in batch])
+                    .on_conflict_do_nothing(index_elements=['item'])
+                    .returning(KeysModel.id)
+                )
+                result = await session.execute(query)
+                inserted = len(result.all())
+                report['inserted'] += inserted
+                report['duplicates'] += len(batch) - inserted
+        if report['inserted']:
+            await change_stock(product_id, report['inserted'], session)
         await session.commit()
-        KeysGet.model_validate(res)
-        return [res]
-    else:
+    except Exception:
+        await session.rollback()
+        raise
+    return report
+
+
+async def select_key(product_id: int, session, quantity: int = 1) -> list[KeysGet]:
+    # Claim and remove the keys in one statement. Rows locked by a concurrent
+    # buyer are skipped, so the same key can never be handed out twice.
+    claimed = (
+        select(KeysModel.id)
+        .where(KeysModel.product_id == product_id)
+        .order_by(asc(KeysModel.id))
+        .limit(quantity)
+        .with_for_update(skip_locked=True)
+    )
+    query = (
+        delete(KeysModel)
+        .where(KeysModel.id.in_(claimed))
+        .returning(KeysModel.item)
+        .execution_options(synchronize_session=False)
+    )
+    result = await session.execute(query)
+    items = result.scalars().all()
+    if len(items) < quantity:
+        await session.rollback()
         raise HTTPException(status_code=404, detail='No keys.')
+    await change_stock(product_id, -len(items), session)
+    await session.commit()
+    return [KeysGet(item=item) for item in items]
 
 
 async def get_prod_by_id(product_id: int, session) -> ProductsGet:
@@ -97,9 +247,22 @@ async def get_prod_by_id(product_id: int, session) -> ProductsGet:
 
 
 async def payment_save(payment: PaymentsPost, session):
-    payment_schema = PaymentsPost.model_validate(payment)
-    new_payment = PaymentsModel(**payment)
-    session.add(new_payment)
+    # Upsert by label, the same payment can be reported by the webhook,
+    # the reconciler and /save-payments
+    payment_dict = PaymentsPost.model_validate(payment).model_dump()
+    insert = _dialect_insert(session)
+    query = (
+        insert(PaymentsModel)
+        .values(**payment_dict)
+        .on_conflict_do_update(index_elements=['uuid'], set_={'status': payment_dict['status']})
+    )
+    await session.execute(query)
     await session.commit()
 
 
+async def get_payment_status(label, session) -> str | None:
+    query = select(PaymentsModel.status).where(PaymentsModel.uuid == label)
+    result = await session.execute(query)
+    return result.scalar_one_or_none()
+
+
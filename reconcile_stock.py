@@ -0,0 +1,22 @@
+import asyncio
+import logging
+
+from database import async_session, engine
+from queries import reconcile_stock
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('reconcile_stock')
+
+
+async def main():
+    async with async_session() as session:
+        fixed = await reconcile_stock(session)
+    if fixed:
+        logger.info("Stock fixed for products: %s", fixed)
+    else:
+        logger.info("Stock is consistent")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
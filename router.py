@@ -1,19 +1,25 @@
+import asyncio
+import hmac
 import logging
 import os
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, Header, Query, Response, HTTPException, Request
 from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import async_session
-from payment_system import make_payment
-from product_service import ProductService
-from queries import add_product, add_key, select_key, get_prod_by_id, payment_save
+from cache import invalidate_touched, local_cache
+from database import async_session, get_redis_client, pool_stats
+from payment_system import make_payment, verify_notification, confirm_payment
+from product_service import ProductService, Page, decode_cursor
+from queries import add_product, add_key, select_key, get_prod_by_id, payment_save, import_keys
 from schemas import ProductPost, KeysPost, ProductsGet, KeysGet, PaymentsPost
+from slow_queries import recent_slow_queries
 
 logger = logging.getLogger('api')
 
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 
 async def get_session() -> AsyncSession:
     async with async_session() as session:
@@ -26,17 +32,19 @@ async def get_session() -> AsyncSession:
             await session.close()
 
 
-async def get_redis():
-    redis = Redis.from_url("redis://localhost:6379",
-                           decode_responses=True)
-    try:
-        yield redis
-    finally:
-        await redis.close()
+async def get_redis() -> Redis:
+    return get_redis_client()
+
+
+async def require_admin(x_admin_token: Annotated[str, Header()] = ""):
+    # Diagnostics show SQL and pool internals, they stay closed while ADMIN_TOKEN is unset
+    if not ADMIN_TOKEN or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail='Forbidden.')
 
 
 RedisDep = Annotated[Redis, Depends(get_redis)]
 SessionDep = Annotated[AsyncSession, Depends(get_session)]
+AdminDep = Depends(require_admin)
 
 router = APIRouter(
     prefix="",
@@ -44,71 +52,136 @@ router = APIRouter(
 )
 
 
-async def get_product_service(
-    session: SessionDep,
-    redis: RedisDep
-) -> ProductService:
-    return ProductService(session, redis)
+async def get_product_service(redis: RedisDep) -> ProductService:
+    return ProductService(redis, async_session)
 
 
 ProductServiceDep = Depends(get_product_service)
 
 
 @router.post("/add_products")
-async def new_product(product: Annotated[ProductPost, Query()], session: SessionDep):
+async def new_product(product: Annotated[ProductPost, Query()], session: SessionDep, redis: RedisDep):
     result = await add_product(product, session)
+    await invalidate_touched(redis, session)
     return result
 
 
 @router.post("/add_keys")
-async def new_key(keys: Annotated[KeysPost, Query()], session: SessionDep):
+async def new_key(keys: Annotated[KeysPost, Query()], session: SessionDep, redis: RedisDep):
     result = await add_key(keys, session)
+    await invalidate_touched(redis, session)
     return result
 
 
-@router.get("/get_products")
+def parse_cursor(after: str | None) -> int | None:
+    if after is None:
+        return None
+    try:
+        return decode_cursor(after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def page_response(page: Page) -> Response:
+    # The body is already the serialized list[ProductsGet], skip re-validation
+    headers = {"X-Total-Count": str(page.total)}
+    if page.next_cursor:
+        headers["X-Next-Cursor"] = page.next_cursor
+    return Response(content=page.body, media_type="application/json", headers=headers)
+
+
+@router.get("/get_products", response_model=list[ProductsGet])
 async def products(category,
                    limit: int = 3,
                    offset: int = 0,
-                    service: ProductService = ProductServiceDep
-                   ) -> list[ProductsGet]:
-    result = await service.get_products(category, limit, offset)
-    return result
+                   after: str | None = None,
+                   service: ProductService = ProductServiceDep
+                   ) -> Response:
+    page = await service.get_products(category, limit, offset, parse_cursor(after))
+    return page_response(page)
 
 
-@router.get("/get_all_products")
+@router.get("/get_all_products", response_model=list[ProductsGet])
 async def all_products(limit: int = 3,
                        offset: int = 0,
-                       service: ProductService = ProductServiceDep) -> list[ProductsGet]:
-    result = await service.get_all_products(limit, offset)
-    return result
+                       after: str | None = None,
+                       service: ProductService = ProductServiceDep) -> Response:
+    page = await service.get_all_products(limit, offset, parse_cursor(after))
+    return page_response(page)
+
+
+@router.get("/search", response_model=list[ProductsGet])
+async def search(q: Annotated[str, Query(min_length=2, max_length=100)],
+                 limit: Annotated[int, Query(ge=1, le=50)] = 10,
+                 offset: Annotated[int, Query(ge=0)] = 0,
+                 service: ProductService = ProductServiceDep) -> Response:
+    page = await service.search(q, limit, offset)
+    return page_response(page)
 
 
 @router.get("/get_keys")
-async def get_keys(product_id: int, session: SessionDep) -> list[KeysGet]:
-    res = await select_key(product_id, session)
+async def get_keys(product_id: int,
+                   session: SessionDep,
+                   redis: RedisDep,
+                   quantity: Annotated[int, Query(ge=1, le=100)] = 1) -> list[KeysGet]:
+    res = await select_key(product_id, session, quantity)
+    await invalidate_touched(redis, session)
     return res
 
 
+KEYS_CHUNK_BYTES = 1024 * 1024
+
+
+async def read_key_chunks(filename: str):
+    # Lines are decoded one by one in import_keys, so a corrupt line is counted as invalid
+    with open(filename, 'rb') as f:
+        while lines := await asyncio.to_thread(f.readlines, KEYS_CHUNK_BYTES):
+            yield lines
+
+
 @router.post("/post_keys_from_file")
-async def post_keys_from_file(filename: str, product_id: int, session: SessionDep):
-    with open(filename, 'r') as f:
-        lines = f.read().splitlines()
-        for line in lines:
-            if line:
-                key = KeysPost.model_validate({'item': line, "product_id": product_id})
-                await add_key(key, session)
-        os.remove(filename)
-        return {"ok: True"}
+async def post_keys_from_file(filename: str, product_id: int, session: SessionDep, redis: RedisDep):
+    report = await import_keys(read_key_chunks(filename), product_id, session)
+    await invalidate_touched(redis, session)
+    os.remove(filename)
+    return {"ok": True, **report}
 
 
 @router.post("/payments")
-async def payment(product_id: int, user_id: int, session: SessionDep):
+async def payment(product_id: int, user_id: int, session: SessionDep, redis: RedisDep):
     product = await get_prod_by_id(product_id, session)
-    res = await make_payment(product=product, user_id=user_id)
+    res = await make_payment(product=product, user_id=user_id, redis=redis)
     return res
 
 
+@router.get("/pool_stats", dependencies=[AdminDep])
+async def get_pool_stats():
+    return pool_stats()
+
+
+@router.get("/cache_stats", dependencies=[AdminDep])
+async def get_cache_stats():
+    return local_cache.stats()
+
+
+@router.get("/slow_queries", dependencies=[AdminDep])
+async def get_slow_queries(limit: Annotated[int, Query(ge=1, le=1000)] = 50, with_plan: bool = False):
+    return recent_slow_queries(limit, with_plan)
+
+
+@router.post("/yoomoney/notify")
+async def yoomoney_notify(request: Request, session: SessionDep, redis: RedisDep):
+    fields = {key: str(value) for key, value in (await request.form()).items()}
+    if not verify_notification(fields):
+        raise HTTPException(status_code=400, detail='Invalid signature.')
+    # Held payments (unaccepted) are reported again once they are accepted
+    if fields.get('unaccepted') == 'true' or not fields.get('label'):
+        return {"ok": True}
+    # withdraw_amount is not covered by sha1_hash, only the signed amount is trusted
+    await confirm_payment(redis, session, fields['label'], float(fields.get('amount') or 0))
+    return {"ok": True}
+
+
 @router.post("/save-payments")
 async def payments_save(payment: PaymentsPost, session: SessionDep):
     await payment_save(payment, session)
@@ -8,6 +8,8 @@ class ProductPost(BaseModel):
     price: int
     category: str
     image: str
+    image_webp: str | None = None
+    thumbnail: str | None = None
 
 
 class ProductsGet(ProductPost):
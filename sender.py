@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from metrics import TELEGRAM_API_DURATION, TELEGRAM_QUEUE_DEPTH
+
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))
+MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+MAX_TRACKED_CHATS = 10000
+
+logger = logging.getLogger('sender')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class SendScheduler(BaseRequestMiddleware):
+    # Every outgoing call waits for its chat's bucket first and the global one
+    # second, so a busy chat only ever delays itself
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: int = CHAT_BURST, max_retries: int = MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, int(global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self.queued = 0
+        self.sent = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self.chats) > MAX_TRACKED_CHATS:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        started = time.monotonic()
+        self.queued += 1
+        TELEGRAM_QUEUE_DEPTH.inc()
+        try:
+            for attempt in range(self.max_retries + 1):
+                chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                if chat_bucket is not None:
+                    await chat_bucket.acquire()
+                await self.global_bucket.acquire()
+                request_started = time.monotonic()
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retries += 1
+                    logger.warning("Flood limit on %s, retrying in %ss", chat_id, e.retry_after)
+                    (chat_bucket or self.global_bucket).pause(e.retry_after)
+                finally:
+                    TELEGRAM_API_DURATION.labels(type(method).__name__).observe(time.monotonic() - request_started)
+        finally:
+            self.queued -= 1
+            TELEGRAM_QUEUE_DEPTH.dec()
+            latency = time.monotonic() - started
+            self.sent += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queued,
+            "sent": self.sent,
+            "retries": self.retries,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+
+send_scheduler = SendScheduler()
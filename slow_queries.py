@@ -0,0 +1,105 @@
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200)) / 1000
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", 0.1))
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", 100))
+
+logger = logging.getLogger('slow_queries')
+
+# DDL, PRAGMA and transaction control can not or must not be explained
+EXPLAINABLE = ("select", "insert", "update", "delete")
+
+# Route or bot handler the current statement runs for, set by the metrics middlewares
+query_context: ContextVar[str | None] = ContextVar("query_context", default=None)
+
+slow_queries: deque[dict] = deque(maxlen=SLOW_QUERY_BUFFER_SIZE)
+
+
+def parameter_shape(parameters, executemany: bool = False):
+    # Types only, bound values may be keys or user ids
+    if executemany:
+        parameters = list(parameters)
+        return {"rows": len(parameters), "row": parameter_shape(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def explainable(statement: str) -> bool:
+    words = statement.split(None, 1)
+    return bool(words) and words[0].lower() in EXPLAINABLE
+
+
+def explain(conn, statement: str, parameters) -> list[str] | None:
+    # A separate DBAPI cursor keeps the results of the original statement intact
+    # and bypasses the engine events
+    dialect = conn.dialect.name
+    cursor = conn.connection.cursor()
+    try:
+        if dialect == "postgresql":
+            # ANALYZE runs the statement again, only reads are repeated and
+            # the savepoint undoes anything it did
+            is_read = statement.lstrip().lower().startswith("select")
+            options = "(ANALYZE, BUFFERS)" if is_read else ""
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(f"EXPLAIN {options} {statement}", parameters)
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        if dialect == "sqlite":
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        return None
+    except Exception:
+        logger.exception("EXPLAIN failed for slow query")
+        return None
+    finally:
+        cursor.close()
+
+
+def instrument_slow_queries(engine, threshold: float = SLOW_QUERY_THRESHOLD,
+                            explain_rate: float = SLOW_QUERY_EXPLAIN_RATE):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["slow_query_started"].pop()
+        if duration < threshold:
+            return
+        entry = {
+            "time": time.time(),
+            "duration_ms": round(duration * 1000, 2),
+            "context": query_context.get(),
+            "statement": statement,
+            "parameters": parameter_shape(parameters, executemany),
+            "plan": None,
+        }
+        logger.warning("Slow query %.1fms in %s: %s %s", entry["duration_ms"], entry["context"],
+                       " ".join(statement.split()), entry["parameters"])
+        if not executemany and explainable(statement) and random.random() < explain_rate:
+            entry["plan"] = explain(conn, statement, parameters)
+        slow_queries.append(entry)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("slow_query_started"):
+            context.connection.info["slow_query_started"].pop()
+
+
+def recent_slow_queries(limit: int | None = None, with_plan: bool = False) -> list[dict]:
+    entries = [entry for entry in reversed(slow_queries) if entry["plan"] or not with_plan]
+    return entries[:limit] if limit else entries
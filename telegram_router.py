@@ -1,27 +1,32 @@
+import asyncio
+import html
 import os
-import uuid
 
 from aiogram import Router, F, Bot
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, \
     InlineKeyboardMarkup, CallbackQuery
+from PIL import Image
 from dotenv import load_dotenv
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import ProductsModel
-from payment_system import check_status
-from queries import total_rows
-from router import new_product, payment, get_keys, post_keys_from_file
-from schemas import ProductPost
-from utils import delete_old, page_view, all_page_view, get_all_products_for_bot, get_products_for_bot
+from database import get_redis_client
+from images import ingest_image
+from payment_system import PaymentReconciler
+from router import new_product, payment, post_keys_from_file
+from schemas import ProductPost, KeysGet
+from sender import send_scheduler
+from utils import delete_old, page_view, all_page_view, get_all_products_for_bot, get_products_for_bot, page_cursor, \
+    remember_cursor, count_pages, search_view, search_products_for_bot
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
+bot.session.middleware(send_scheduler)
 router = Router()
 whitelist = [5863456999]
 
@@ -59,29 +64,34 @@ async def start_handler(message: Message):
 
 
 @router.message(Command('add_keys'))
-async def add_keys_handler(message: Message, state: FSMContext, session: AsyncSession):
+async def add_keys_handler(message: Message, state: FSMContext):
     if message.from_user.id not in whitelist:
         return None
-    total_pages = (await total_rows(ProductsModel, session) + 2) // 3
     offset = 0
     chat_id = message.chat.id
-    data = await get_all_products_for_bot(offset=offset)
+    data, page = await get_all_products_for_bot(offset=offset)
+    total_pages = count_pages(page)
     messages = await all_page_view(bot, data, chat_id, total_pages, offset, offset)
-    await state.update_data(total=total_pages, messages=messages)
+    cursors = remember_cursor([], 0, page.next_cursor)
+    await state.update_data(total=total_pages, page=offset, messages=messages, cursors=cursors)
 
 
 @router.callback_query(F.data.startswith('all_pages_'))
 async def page_handler(call: CallbackQuery, state: FSMContext):
     state_data = await state.get_data()
     page_num = int(call.data.split('all_pages_')[1])
-    total_pages = state_data['total']
     chat_id = call.message.chat.id
     offset = page_num * 3
-    data = await get_all_products_for_bot(offset=offset)
-    messages = state_data['messages']
-    await delete_old(chat_id,  bot)
-    messages = await all_page_view(bot, data, chat_id, total_pages, page_num, offset)
-    await state.update_data(messages=messages)
+    cursors = state_data.get('cursors', [])
+    data, page = await get_all_products_for_bot(offset=offset, after=page_cursor(cursors, page_num))
+    total_pages = count_pages(page)
+    # The old page is removed while the new one is being sent
+    _, messages = await asyncio.gather(
+        delete_old(chat_id, state_data['messages'], bot),
+        all_page_view(bot, data, chat_id, total_pages, page_num, offset)
+    )
+    await state.update_data(total=total_pages, page=page_num, messages=messages,
+                            cursors=remember_cursor(cursors, page_num, page.next_cursor))
 
 
 @router.callback_query(F.data.startswith('pick_'))
@@ -98,7 +108,10 @@ async def add_keys_file(message: Message, state: FSMContext, session: AsyncSessi
     data = await state.get_data()
     product_id = data['product_id']
     await bot.download(file=message.document, destination=directory)
-    await post_keys_from_file(directory, product_id, session)
+    report = await post_keys_from_file(directory, product_id, session, get_redis_client())
+    await message.answer(f"Добавлено ключей: {report['inserted']}\n"
+                         f"Дубликаты: {report['duplicates']}\n"
+                         f"Некорректные строки: {report['invalid']}")
     await state.clear()
 
 
@@ -151,14 +164,19 @@ async def add_product_price(message: Message, state: FSMContext):
 
 @router.message(F.photo, StateFilter(AddProductState.image))
 async def add_product_photo(message: Message, state: FSMContext, session: AsyncSession):
-    directory = f'images/{uuid.uuid1()}.png'
-    await state.update_data(image=directory)
+    upload = await message.bot.download(file=message.photo[-1].file_id)
+    try:
+        variants = await ingest_image(upload.getvalue())
+    # Unreadable and truncated files raise OSError, oversized ones DecompressionBombError
+    except (OSError, Image.DecompressionBombError):
+        await message.answer('Не удалось прочитать изображение.\nОтправьте другое изображение.')
+        return
+    await state.update_data(**variants)
     data = await state.get_data()
     product = ProductPost.model_validate(data)
-    await new_product(product, session)
+    await new_product(product, session, get_redis_client())
     await message.answer("Товар успешно добавлен!")
     await state.clear()
-    await message.bot.download(file=message.photo[-1].file_id, destination=directory)
 
 
 @router.message(StateFilter(AddProductState.image))
@@ -167,28 +185,51 @@ async def is_photo(message: Message):
 
 
 @router.callback_query(F.data.startswith('catalog_'))
-async def catalog(call: CallbackQuery, state: FSMContext, session: AsyncSession):
+async def catalog(call: CallbackQuery, state: FSMContext):
     category = call.data.split('catalog_')[1]
-    total_pages = (await total_rows(ProductsModel, session) + 2) // 3
     offset = 0
     chat_id = call.message.chat.id
-    data = await get_products_for_bot(category, offset)
+    data, page = await get_products_for_bot(category, offset)
+    total_pages = count_pages(page)
     messages = await page_view(bot, data, chat_id, total_pages, offset, offset)
-    await state.update_data(total=total_pages, messages=messages, category=category)
+    cursors = remember_cursor([], 0, page.next_cursor)
+    await state.update_data(total=total_pages, page=offset, messages=messages, category=category, cursors=cursors)
 
 
 @router.callback_query(F.data.startswith('page_'))
 async def page_handler(call: CallbackQuery, state: FSMContext):
     state_data = await state.get_data()
     page_num = int(call.data.split('page_')[1])
-    total_pages = state_data['total']
     category = state_data['category']
     chat_id = call.message.chat.id
     offset = page_num * 3
-    data = await get_products_for_bot(category, offset=offset)
-    messages = state_data['messages']
-    await delete_old(chat_id, messages, bot)
-    messages = await page_view(bot, data, chat_id, total_pages, page_num, offset)
+    cursors = state_data.get('cursors', [])
+    data, page = await get_products_for_bot(category, offset=offset, after=page_cursor(cursors, page_num))
+    total_pages = count_pages(page)
+    # The old page is removed while the new one is being sent
+    _, messages = await asyncio.gather(
+        delete_old(chat_id, state_data['messages'], bot),
+        page_view(bot, data, chat_id, total_pages, page_num, offset)
+    )
+    await state.update_data(total=total_pages, page=page_num, messages=messages,
+                            cursors=remember_cursor(cursors, page_num, page.next_cursor))
+
+
+@router.message(Command('search'))
+async def search_handler(message: Message, command: CommandObject, state: FSMContext):
+    query = (command.args or '').strip()
+    if len(query) < 2:
+        await message.answer('Напишите, что найти: /search название товара')
+        return
+    data, page = await search_products_for_bot(query)
+    if not data:
+        await message.answer('По вашему запросу ничего не найдено.')
+        return
+    state_data = await state.get_data()
+    _, messages = await asyncio.gather(
+        delete_old(message.chat.id, state_data.get('messages'), bot),
+        search_view(bot, data, message.chat.id)
+    )
     await state.update_data(messages=messages)
 
 
@@ -212,7 +253,7 @@ async def buy_product(call: CallbackQuery, state: FSMContext, session: AsyncSess
     await delete_old(chat_id, data, bot)
     await state.clear()
     product_id = int(call.data.split('buy_')[1])
-    res = await payment(product_id, user_id=call.from_user.id, session=session)
+    res = await payment(product_id, user_id=call.from_user.id, session=session, redis=get_redis_client())
     product = res["product"]
     inline_kb_list = [
         [InlineKeyboardButton(text='Оплатиь с помощью yoomoney', url=res["URL"])],
@@ -224,13 +265,18 @@ async def buy_product(call: CallbackQuery, state: FSMContext, session: AsyncSess
 
 
 @router.callback_query(F.data.startswith('check_'))
-async def check(call: CallbackQuery, session: AsyncSession):
-    label = uuid.UUID(call.data.split('_')[1])
-    prodict_id = int(call.data.split('_')[2])
-    user_id = call.from_user.id
-    res = await check_status(label, user_id, prodict_id, session)
-    if res:
-        key = await get_keys(prodict_id, session)
-        await bot.send_message(f'Вы успешно оплатили товар, вот ваш ключ:\n<blockquote>{key}</blockquote>')
+async def check(call: CallbackQuery, reconciler: PaymentReconciler):
+    label = call.data.split('_')[1]
+    if await reconciler.check(label):
+        await call.answer('Оплата получена!')
     else:
         await call.answer('Оплата еще не прошла, возможны задержки.\nПовторите попытку позже.', show_alert=True)
+
+
+async def notify_paid(user_id: int, product_id: int, keys: list[KeysGet]):
+    if keys:
+        items = '\n'.join(html.escape(key.item) for key in keys)
+        text = f'Вы успешно оплатили товар, вот ваш ключ:\n<blockquote>{items}</blockquote>'
+    else:
+        text = 'Оплата получена, но ключи к товару закончились. Мы свяжемся с вами.'
+    await bot.send_message(user_id, text, parse_mode=ParseMode.HTML)
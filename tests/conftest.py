@@ -0,0 +1,84 @@
+import datetime
+import os
+import tempfile
+
+import pytest
+
+# Settings are read from the environment at import time
+_workdir = tempfile.mkdtemp(prefix='shop_tests_')
+os.environ.setdefault('DB_URL', f"sqlite+aiosqlite:///{os.path.join(_workdir, 'store.db')}")
+os.environ['YOO_NOTIFICATION_SECRET'] = 'test-secret'
+os.environ['ADMIN_TOKEN'] = 'test-admin'
+
+import httpx  # noqa: E402
+from fakeredis import FakeAsyncRedis  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+
+import database  # noqa: E402
+import main  # noqa: E402
+from cache import local_cache  # noqa: E402
+from models import Categories, KeysModel, ProductsModel  # noqa: E402
+
+if database.DB_URL.startswith("sqlite"):
+    # The payments.date default is TIMEZONE('utc', now()), give SQLite both
+    @event.listens_for(database.engine.sync_engine, "connect")
+    def sqlite_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function(
+            "now", 0, lambda: datetime.datetime.now(datetime.UTC).strftime('%Y-%m-%d %H:%M:%S.%f'))
+        dbapi_connection.create_function("TIMEZONE", 2, lambda zone, value: value)
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+async def redis():
+    # fakeredis needs its Lua extra for the cache fill lock: pip install fakeredis[lua]
+    client = FakeAsyncRedis()
+    database.redis_client = client
+    local_cache.clear()
+    yield client
+    database.redis_client = None
+    local_cache.clear()
+    await client.aclose()
+
+
+@pytest.fixture
+async def db():
+    await database.delete_tables()
+    await database.create_tables()
+    yield database.async_session
+    # Pooled connections belong to the event loop of this test
+    await database.engine.dispose()
+
+
+@pytest.fixture
+async def client(db, redis):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+        yield client
+
+
+@pytest.fixture
+def make_product(db):
+    return add_product
+
+
+async def add_product(keys: int = 0, category: Categories = Categories.games, price: int = 100) -> int:
+    async with database.async_session() as session:
+        product_id = (await session.execute(insert(ProductsModel).returning(ProductsModel.id), {
+            'title': 'Product',
+            'description': 'Lorem ipsum',
+            'category': category,
+            'price': price,
+            'image': 'images/1.png',
+            'stock': keys,
+        })).scalar_one()
+        if keys:
+            await session.execute(insert(KeysModel), [
+                {'item': f'KEY-{product_id}-{n}', 'product_id': product_id} for n in range(keys)
+            ])
+        await session.commit()
+    return product_id
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from slow_queries import instrument_slow_queries, slow_queries
+
+pytestmark = pytest.mark.anyio
+
+DIAGNOSTICS = ['/pool_stats', '/cache_stats', '/slow_queries']
+
+
+@pytest.mark.parametrize('path', DIAGNOSTICS)
+async def test_diagnostics_need_the_admin_token(client, path):
+    assert (await client.get(path)).status_code == 403
+    assert (await client.get(path, headers={'X-Admin-Token': 'wrong'})).status_code == 403
+    assert (await client.get(path, headers={'X-Admin-Token': 'test-admin'})).status_code == 200
+
+
+async def test_only_statements_that_can_be_planned_are_explained():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    # Every statement is "slow" and explained
+    instrument_slow_queries(engine, threshold=0, explain_rate=1)
+    slow_queries.clear()
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)"))
+        await conn.execute(text("CREATE INDEX ix_items_name ON items (name)"))
+        await conn.execute(text("PRAGMA table_info(items)"))
+        await conn.execute(text("INSERT INTO items (name) VALUES ('a')"))
+        await conn.execute(text("UPDATE items SET name = 'b' WHERE id = 1"))
+        await conn.execute(text("SELECT name FROM items WHERE name = 'b'"))
+        await conn.execute(text("DELETE FROM items WHERE id = 1"))
+    await engine.dispose()
+
+    plans = {entry['statement'].split()[0]: entry['plan'] for entry in slow_queries}
+    slow_queries.clear()
+    assert plans['CREATE'] is None
+    assert plans['PRAGMA'] is None
+    # SQLite has no plan steps for a plain INSERT ... VALUES, but it was explained
+    assert all(plans[verb] is not None for verb in ('INSERT', 'UPDATE', 'SELECT', 'DELETE')), plans
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import select
+
+import database
+from models import KeysModel, ProductsModel
+from queries import MAX_KEY_LENGTH
+
+pytestmark = pytest.mark.anyio
+
+
+async def stored_keys(product_id: int) -> tuple[list[str], int]:
+    async with database.async_session() as session:
+        items = (await session.scalars(select(KeysModel.item).where(KeysModel.product_id == product_id)
+                                       .order_by(KeysModel.id))).all()
+        stock = await session.scalar(select(ProductsModel.stock).where(ProductsModel.id == product_id))
+    return list(items), stock
+
+
+async def test_keys_file_is_imported(client, make_product, tmp_path):
+    product_id = await make_product()
+    path = tmp_path / 'keys.txt'
+    path.write_bytes(
+        b'KEY-1\n'
+        b'\xff\xfeBAD\n'
+        b'\n'
+        b'KEY-2\r\n'
+        b'KEY-1\n'
+        + b'L' * (MAX_KEY_LENGTH + 1) + b'\n'
+        + 'КЛЮЧ-3'.encode() + b'\n'
+        b'BAD\x07BELL\n'
+    )
+
+    response = await client.post('/post_keys_from_file', params={'filename': str(path), 'product_id': product_id})
+
+    assert response.status_code == 200
+    assert response.json() == {'ok': True, 'inserted': 3, 'duplicates': 1, 'invalid': 3}
+    # Undecodable lines are rejected instead of stored with replacement characters
+    assert await stored_keys(product_id) == (['KEY-1', 'KEY-2', 'КЛЮЧ-3'], 3)
+    assert not path.exists()
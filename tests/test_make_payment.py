@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+import payment_system
+from payment_system import PENDING_DATA_KEY
+
+pytestmark = pytest.mark.anyio
+
+
+class ThreadRecordingQuickpay:
+    # Stands in for yoomoney.Quickpay, which posts to YooMoney from its constructor
+    built = []
+
+    def __init__(self, **params):
+        self.built.append(self)
+        self.thread = threading.get_ident()
+        self.params = params
+        self.redirected_url = f"https://yoomoney.ru/quickpay/confirm?label={params['label']}"
+
+
+async def test_payment_link_is_built_off_the_event_loop(client, make_product, redis, monkeypatch):
+    monkeypatch.setattr(payment_system, 'Quickpay', ThreadRecordingQuickpay)
+    product_id = await make_product(keys=1, price=150)
+
+    response = await client.post('/payments', params={'product_id': product_id, 'user_id': 7})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body['URL'].endswith(body['label'])
+    assert ThreadRecordingQuickpay.built[0].thread != threading.get_ident()
+    assert ThreadRecordingQuickpay.built[0].params['sum'] == 150
+    assert await redis.hexists(PENDING_DATA_KEY, body['label'])
@@ -0,0 +1,14 @@
+import pytest
+
+from plan_check import run_checks
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_hot_queries_use_their_indexes():
+    # Seeds its own in-memory database, python plan_check.py --url runs the same checks on Postgres
+    results = await run_checks("sqlite+aiosqlite:///:memory:")
+
+    failures = [f"{name}, {failure}" for name, failure in results if failure is not None]
+    assert len(results) == 9
+    assert not failures, "\n".join(failures)
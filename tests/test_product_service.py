@@ -0,0 +1,70 @@
+import asyncio
+
+import orjson
+import pytest
+from sqlalchemy import event
+
+import database
+from models import Categories
+from product_service import ProductService
+
+pytestmark = pytest.mark.anyio
+
+CALLERS = 50
+
+
+@pytest.fixture
+def statements():
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(database.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    yield executed
+    event.remove(database.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+async def products(make_product):
+    return [await make_product(keys=1, category=Categories.games) for _ in range(5)]
+
+
+async def test_concurrent_misses_query_the_database_once(db, redis, products, statements):
+    service = ProductService(redis, db)
+
+    pages = await asyncio.gather(*(service.get_products('games') for _ in range(CALLERS)))
+
+    # One listing query and one count, whatever the number of callers
+    assert len(statements) == 2, statements
+    assert len({page.body for page in pages}) == 1
+    assert [product['id'] for product in orjson.loads(pages[0].body)] == products[:3]
+    assert pages[0].total == len(products)
+
+
+class GatedProductService(ProductService):
+    def __init__(self, *args, gate: asyncio.Event, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gate = gate
+
+    async def _query(self, query, *args):
+        await self.gate.wait()
+        return await super()._query(query, *args)
+
+
+async def test_cancelled_first_caller_does_not_break_the_shared_fill(db, redis, products, statements):
+    gate = asyncio.Event()
+    service = GatedProductService(redis, db, gate=gate)
+
+    first = asyncio.create_task(service.get_products('games'))
+    others = [asyncio.create_task(service.get_products('games')) for _ in range(CALLERS - 1)]
+    await asyncio.sleep(0.05)
+    # The first caller started the fill and is cancelled while it is still running
+    first.cancel()
+    gate.set()
+
+    pages = await asyncio.gather(*others)
+
+    assert first.cancelled()
+    assert len(statements) == 2, statements
+    assert all(page.total == len(products) for page in pages)
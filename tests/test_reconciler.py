@@ -0,0 +1,280 @@
+import asyncio
+import time
+import uuid
+
+import orjson
+import pytest
+from sqlalchemy import func, select
+
+from models import KeysModel, PaymentsModel, ProductsModel
+from payment_system import DELIVERING_KEY, PENDING_DATA_KEY, PENDING_KEY, PAYMENT_TIMEOUT, POLL_INTERVAL, \
+    PaymentReconciler, ProviderOperation, confirm_payment, track_payment
+
+pytestmark = pytest.mark.anyio
+
+PRICE = 100
+USER_ID = 7
+
+
+class FakeProvider:
+    def __init__(self, operations: dict[str, ProviderOperation] | None = None):
+        self.operations = operations or {}
+        self.calls = []
+        self.called = asyncio.Event()
+        # Set to an unset event to hold the reconciler inside the provider request
+        self.gate: asyncio.Event | None = None
+        self.error: Exception | None = None
+
+    async def statuses(self, labels, since):
+        self.calls.append(list(labels))
+        self.called.set()
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        return {label: self.operations[label] for label in labels if label in self.operations}
+
+
+class RecordingNotify:
+    def __init__(self):
+        self.calls = []
+        self.failures = 0
+
+    async def __call__(self, user_id: int, product_id: int, keys):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Telegram is down')
+        self.calls.append((user_id, product_id, [key.item for key in keys]))
+
+
+@pytest.fixture
+def provider():
+    return FakeProvider()
+
+
+@pytest.fixture
+def notify():
+    return RecordingNotify()
+
+
+@pytest.fixture
+def reconciler(redis, db, provider, notify):
+    return PaymentReconciler(redis, db, provider, notify=notify)
+
+
+@pytest.fixture
+async def product_id(make_product):
+    return await make_product(keys=2, price=PRICE)
+
+
+async def new_payment(redis, product_id: int, created: float | None = None) -> str:
+    label = str(uuid.uuid1())
+    await track_payment(redis, label, USER_ID, product_id, PRICE)
+    payment = await stored(redis, label)
+    if created is not None:
+        payment['created'] = created
+        await redis.hset(PENDING_DATA_KEY, label, orjson.dumps(payment))
+    # Due right away instead of after the first poll interval
+    await redis.zadd(PENDING_KEY, {label: time.time() - 1})
+    return label
+
+
+async def stored(redis, label: str) -> dict | None:
+    raw = await redis.hget(PENDING_DATA_KEY, label)
+    return orjson.loads(raw) if raw else None
+
+
+async def confirm(db, redis, label: str):
+    async with db() as session:
+        assert await confirm_payment(redis, session, label, PRICE)
+
+
+async def remaining_keys(db, product_id: int) -> tuple[int, int]:
+    async with db() as session:
+        keys = await session.scalar(select(func.count()).where(KeysModel.product_id == product_id))
+        stock = await session.scalar(select(ProductsModel.stock).where(ProductsModel.id == product_id))
+    return keys, stock
+
+
+async def payment_statuses(db, label: str) -> list[str]:
+    async with db() as session:
+        result = await session.execute(select(PaymentsModel.status).where(PaymentsModel.uuid == uuid.UUID(label)))
+        return list(result.scalars())
+
+
+async def confirm_while_polling(reconciler, provider, db, redis, label: str):
+    provider.gate = asyncio.Event()
+    poll = asyncio.create_task(reconciler.poll_once())
+    await provider.called.wait()
+    await confirm(db, redis, label)
+    provider.gate.set()
+    await poll
+
+
+async def test_notification_during_provider_poll_is_not_rescheduled(reconciler, provider, notify, db, redis,
+                                                                    product_id):
+    label = await new_payment(redis, product_id)
+
+    await confirm_while_polling(reconciler, provider, db, redis, label)
+
+    # The poll saw the payment as pending, it must not overwrite the confirmation
+    assert (await stored(redis, label))['status'] == 'success'
+    assert await redis.zscore(PENDING_KEY, label) == 0
+    await reconciler.poll_once()
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+
+
+async def test_notification_during_provider_poll_is_not_timed_out(reconciler, provider, notify, db, redis,
+                                                                  product_id):
+    label = await new_payment(redis, product_id, created=time.time() - PAYMENT_TIMEOUT - 1)
+
+    await confirm_while_polling(reconciler, provider, db, redis, label)
+
+    assert (await stored(redis, label))['status'] == 'success'
+    await reconciler.poll_once()
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+
+
+async def test_polled_payment_is_delivered(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    # The operation history reports the amount after the YooMoney fee
+    provider.operations[label] = ProviderOperation('success', PRICE * 0.98)
+
+    assert await reconciler.poll_once() == POLL_INTERVAL
+
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    assert await payment_statuses(db, label) == ['success']
+    assert await remaining_keys(db, product_id) == (1, 1)
+    assert await stored(redis, label) is None
+    assert await redis.zscore(PENDING_KEY, label) is None
+    assert await redis.zscore(DELIVERING_KEY, label) is None
+
+
+async def test_underpaid_polled_payment_is_dropped(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    provider.operations[label] = ProviderOperation('success', PRICE / 2)
+
+    await reconciler.poll_once()
+
+    assert notify.calls == []
+    assert await payment_statuses(db, label) == []
+    assert await remaining_keys(db, product_id) == (2, 2)
+    assert await stored(redis, label) is None
+    assert await redis.zscore(PENDING_KEY, label) is None
+
+
+async def test_unpaid_payment_backs_off(reconciler, provider, notify, redis, product_id):
+    label = await new_payment(redis, product_id)
+
+    for attempt in (1, 2):
+        started = time.time()
+        await reconciler.poll_once()
+        assert (await stored(redis, label))['attempts'] == attempt
+        due = await redis.zscore(PENDING_KEY, label)
+        assert started + POLL_INTERVAL * 2 ** attempt <= due <= time.time() + POLL_INTERVAL * 2 ** attempt
+        await redis.zadd(PENDING_KEY, {label: time.time() - 1})
+
+    assert notify.calls == []
+
+
+async def test_unpaid_payment_times_out(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id, created=time.time() - PAYMENT_TIMEOUT - 1)
+
+    await reconciler.poll_once()
+
+    assert notify.calls == []
+    assert await stored(redis, label) is None
+    assert await redis.zscore(PENDING_KEY, label) is None
+
+
+async def test_provider_outage_backs_off_and_still_delivers_confirmed(reconciler, provider, notify, db, redis,
+                                                                     product_id):
+    unconfirmed = await new_payment(redis, product_id)
+    confirmed = await new_payment(redis, product_id)
+    await confirm(db, redis, confirmed)
+    provider.error = RuntimeError('YooMoney is down')
+
+    assert await reconciler.poll_once() == POLL_INTERVAL * 2
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    # The unconfirmed payment is left for the next poll as it was
+    assert (await stored(redis, unconfirmed))['attempts'] == 0
+
+    assert await reconciler.poll_once() == POLL_INTERVAL * 4
+
+    provider.error = None
+    assert await reconciler.poll_once() == POLL_INTERVAL
+    assert reconciler.failures == 0
+    assert (await stored(redis, unconfirmed))['attempts'] == 1
+
+
+async def test_failed_delivery_is_retried_with_the_same_keys(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    await confirm(db, redis, label)
+    notify.failures = 1
+
+    await reconciler.poll_once()
+
+    assert notify.calls == []
+    payment = await stored(redis, label)
+    assert payment['keys'] == [f'KEY-{product_id}-0']
+    assert await redis.zscore(DELIVERING_KEY, label) is None
+    assert await redis.zscore(PENDING_KEY, label) > time.time()
+
+    await redis.zadd(PENDING_KEY, {label: time.time() - 1})
+    await reconciler.poll_once()
+
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    # The retry sent the key it already took instead of taking another one
+    assert await remaining_keys(db, product_id) == (1, 1)
+    assert await stored(redis, label) is None
+
+
+async def test_only_one_worker_claims_a_delivery(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    await confirm(db, redis, label)
+    payment = await stored(redis, label)
+
+    results = await asyncio.gather(*(reconciler.complete(label, dict(payment)) for _ in range(5)))
+
+    assert sorted(results) == [False] * 4 + [True]
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    assert await remaining_keys(db, product_id) == (1, 1)
+
+
+async def test_stale_delivery_lease_is_requeued(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    await confirm(db, redis, label)
+    # A worker claimed the delivery and died before it finished
+    await redis.zrem(PENDING_KEY, label)
+    await redis.zadd(DELIVERING_KEY, {label: time.time() - 1})
+
+    await reconciler.poll_once()
+
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    assert await redis.zscore(DELIVERING_KEY, label) is None
+    assert await stored(redis, label) is None
+
+
+async def test_live_delivery_lease_is_left_alone(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    await confirm(db, redis, label)
+    await redis.zrem(PENDING_KEY, label)
+    await redis.zadd(DELIVERING_KEY, {label: time.time() + 60})
+
+    await reconciler.poll_once()
+
+    assert notify.calls == []
+    assert await redis.zscore(DELIVERING_KEY, label) is not None
+
+
+async def test_check_delivers_a_confirmed_payment(reconciler, provider, notify, db, redis, product_id):
+    label = await new_payment(redis, product_id)
+    assert not await reconciler.check(label)
+
+    await confirm(db, redis, label)
+
+    assert await reconciler.check(label)
+    assert notify.calls == [(USER_ID, product_id, [f'KEY-{product_id}-0'])]
+    # Delivered payments are answered from the database
+    assert await reconciler.check(label)
+    assert provider.calls == []
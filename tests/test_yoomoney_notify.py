@@ -0,0 +1,125 @@
+import uuid
+
+import orjson
+import pytest
+from sqlalchemy import func, select
+
+from models import PaymentsModel
+from payment_system import PENDING_DATA_KEY, PENDING_KEY, WAKE_KEY, notification_signature, track_payment
+
+pytestmark = pytest.mark.anyio
+
+PRICE = 100
+
+
+def notification(label: str, secret: str = 'test-secret', **overrides) -> dict:
+    fields = {
+        'notification_type': 'p2p-incoming',
+        'operation_id': '1234567',
+        'amount': '98.00',
+        'withdraw_amount': f'{PRICE}.00',
+        'currency': '643',
+        'datetime': '2026-10-18T12:00:00Z',
+        'sender': '41001000040',
+        'codepro': 'false',
+        'label': label,
+        **overrides,
+    }
+    fields['sha1_hash'] = notification_signature(fields, secret)
+    return fields
+
+
+@pytest.fixture
+async def label(redis, make_product):
+    product_id = await make_product(keys=1, price=PRICE)
+    label = uuid.uuid1()
+    await track_payment(redis, label, 7, product_id, PRICE)
+    return str(label)
+
+
+async def payment_statuses(session_pool, label: str) -> list[str]:
+    async with session_pool() as session:
+        result = await session.execute(select(PaymentsModel.status).where(PaymentsModel.uuid == uuid.UUID(label)))
+        return list(result.scalars())
+
+
+async def pending_status(redis, label: str) -> str:
+    return orjson.loads(await redis.hget(PENDING_DATA_KEY, label))['status']
+
+
+async def test_signed_notification_confirms_payment(client, db, redis, label):
+    response = await client.post('/yoomoney/notify', data=notification(label))
+
+    assert response.status_code == 200
+    assert await payment_statuses(db, label) == ['success']
+    assert await pending_status(redis, label) == 'success'
+    # The reconciler is woken up to deliver right away
+    assert await redis.zscore(PENDING_KEY, label) == 0
+    assert await redis.lrange(WAKE_KEY, 0, -1) == [label.encode()]
+
+
+async def test_bad_signature_is_rejected(client, db, redis, label):
+    response = await client.post('/yoomoney/notify', data=notification(label, secret='wrong-secret'))
+
+    assert response.status_code == 400
+    assert await payment_statuses(db, label) == []
+    assert await pending_status(redis, label) == 'pending'
+
+
+async def test_tampered_amount_is_rejected(client, db, redis, label):
+    fields = notification(label, amount='1.00')
+    fields['amount'] = f'{PRICE}.00'
+    response = await client.post('/yoomoney/notify', data=fields)
+
+    assert response.status_code == 400
+    assert await payment_statuses(db, label) == []
+
+
+async def test_unsigned_withdraw_amount_is_not_trusted(client, db, redis, label):
+    # withdraw_amount is not covered by sha1_hash, only the signed amount counts
+    fields = notification(label, amount='49.00', withdraw_amount='50.00')
+    fields['withdraw_amount'] = f'{PRICE}.00'
+    response = await client.post('/yoomoney/notify', data=fields)
+
+    assert response.status_code == 200
+    assert await payment_statuses(db, label) == []
+    assert await pending_status(redis, label) == 'pending'
+
+
+async def test_replayed_notification_is_idempotent(client, db, redis, label):
+    fields = notification(label)
+    for _ in range(3):
+        response = await client.post('/yoomoney/notify', data=fields)
+        assert response.status_code == 200
+
+    async with db() as session:
+        payments = await session.scalar(select(func.count()).select_from(PaymentsModel))
+    assert payments == 1
+    assert await payment_statuses(db, label) == ['success']
+    assert await pending_status(redis, label) == 'success'
+
+
+async def test_underpaid_notification_is_not_confirmed(client, db, redis, label):
+    response = await client.post('/yoomoney/notify', data=notification(label, amount='49.00', withdraw_amount='50.00'))
+
+    assert response.status_code == 200
+    assert await payment_statuses(db, label) == []
+    assert await pending_status(redis, label) == 'pending'
+    assert await redis.llen(WAKE_KEY) == 0
+
+
+async def test_unaccepted_notification_is_not_confirmed(client, db, redis, label):
+    response = await client.post('/yoomoney/notify', data=notification(label, unaccepted='true'))
+
+    assert response.status_code == 200
+    assert await payment_statuses(db, label) == []
+    assert await pending_status(redis, label) == 'pending'
+    assert await redis.llen(WAKE_KEY) == 0
+
+
+async def test_unknown_label_is_ignored(client, db, redis):
+    label = str(uuid.uuid1())
+    response = await client.post('/yoomoney/notify', data=notification(label))
+
+    assert response.status_code == 200
+    assert await payment_statuses(db, label) == []
@@ -1,18 +1,62 @@
+import os
+
+import orjson
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
-from redis.asyncio import Redis
 
-from database import async_session
-from product_service import ProductService
-from router import all_products, products
-from schemas import ProductsGet
+from database import async_session, get_redis_client
+from product_service import ProductService, Page, decode_cursor
+
+
+FILE_IDS_KEY = "tg:file_ids"
+
+
+def _image_version(path: str) -> str:
+    # A changed file gets a new mtime and is uploaded again
+    try:
+        return f"{path}:{os.stat(path).st_mtime_ns}"
+    except OSError:
+        return path
+
+
+async def send_product_photo(bot, chat_id, image: str, **kwargs):
+    redis = get_redis_client()
+    version = _image_version(image)
+    if file_id := await redis.hget(FILE_IDS_KEY, version):
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id.decode(), **kwargs)
+        except TelegramBadRequest:
+            await redis.hdel(FILE_IDS_KEY, version)
+    mess = await bot.send_photo(chat_id=chat_id, photo=FSInputFile(image), **kwargs)
+    await redis.hset(FILE_IDS_KEY, version, mess.photo[-1].file_id)
+    return mess
+
 
+def product_caption(product: dict) -> str:
+    return (f"<b>{product['title']}</b>\n"
+            f"{product['description']}\n\n"
+            f"Цена: {product['price']}RUB\n"
+            f"Коллиество штук {product['remainder']}"
+            )
 
-async def delete_old(chat_id, messages: list, bot):
+
+def message_ids(messages: list | None) -> list[int]:
+    # FSM state keeps only message ids, older states may still hold whole messages
     ids = []
-    for mess in messages:
-        ids.append(mess.message_id)
-    await bot.delete_messages(chat_id, ids)
+    for mess in messages or []:
+        if isinstance(mess, int):
+            ids.append(mess)
+        elif isinstance(mess, dict):
+            ids.append(mess['message_id'])
+        else:
+            ids.append(mess.message_id)
+    return ids
+
+
+async def delete_old(chat_id, messages: list | None, bot):
+    if ids := message_ids(messages):
+        await bot.delete_messages(chat_id, ids)
 
 
 async def page_view(bot, data, chat_id, total_pages, page_num, offset):
@@ -23,12 +67,7 @@ async def page_view(bot, data, chat_id, total_pages, page_num, offset):
                 product_dict = product.model_dump()
             else:
                 product_dict = product
-            image = FSInputFile(product_dict['image'])
-            text = (f"<b>{product_dict['title']}</b>\n"
-                    f"{product_dict['description']}\n\n"
-                    f"Цена: {product_dict['price']}RUB\n"
-                    f"Коллиество штук {product_dict['remainder']}"
-                    )
+            text = product_caption(product_dict)
             inline_kb_list = [
                 [InlineKeyboardButton(text='Купить', callback_data=f'buy_{product_dict['id']}')]
 
@@ -55,14 +94,15 @@ async def page_view(bot, data, chat_id, total_pages, page_num, offset):
                                                             callback_data=f'delete_list')])
 
             kb = InlineKeyboardMarkup(inline_keyboard=inline_kb_list)
-            mess = await bot.send_photo(
-                chat_id=chat_id,
-                photo=image,
+            mess = await send_product_photo(
+                bot,
+                chat_id,
+                product_dict['image'],
                 caption=text,
                 parse_mode=ParseMode.HTML,
                 reply_markup=kb)
 
-            messages.append(mess)
+            messages.append(mess.message_id)
         return messages
     else:
         await bot.send_message(chat_id, "В данной категории отсутствуют товары. Возможно они появятся позже")
@@ -76,12 +116,7 @@ async def all_page_view(bot, data, chat_id, total_pages, page_num, offset):
                 product_dict = product.model_dump()
             else:
                 product_dict = product
-            image = FSInputFile(product_dict['image'])
-            text = (f"<b>{product_dict['title']}</b>\n"
-                    f"{product_dict['description']}\n\n"
-                    f"Цена: {product_dict['price']}RUB\n"
-                    f"Коллиество штук {product_dict['remainder']}"
-                    )
+            text = product_caption(product_dict)
             inline_kb_list = [
                 [InlineKeyboardButton(text='Выбрать', callback_data=f'pick_{product_dict['id']}')]
 
@@ -93,44 +128,80 @@ async def all_page_view(bot, data, chat_id, total_pages, page_num, offset):
                                                             callback_data=f'delete_list')])
             elif ((page_num + 1) < total_pages and (page_num + 1) != 1) and (len(messages) == len(data) - 1):
                 inline_kb_list.append([InlineKeyboardButton(text="Cледующая страница",
-                                                            callback_data=f'page_{page_num + 1}')])
+                                                            callback_data=f'all_pages_{page_num + 1}')])
                 inline_kb_list.append([InlineKeyboardButton(text="Предыдущая страница",
                                                             callback_data=f'all_pages_{page_num - 1}')])
                 inline_kb_list.append([InlineKeyboardButton(text="Убрать список",
                                                             callback_data=f'delete_list')])
             elif len(messages) == len(data) - 1:
+                inline_kb_list.append([InlineKeyboardButton(text="Cледующая страница",
+                                                            callback_data=f'all_pages_{page_num + 1}')])
                 inline_kb_list.append([InlineKeyboardButton(text="Убрать список",
                                                             callback_data=f'delete_list')])
 
             kb = InlineKeyboardMarkup(inline_keyboard=inline_kb_list)
-            mess = await bot.send_photo(
-                chat_id=chat_id,
-                photo=image,
+            mess = await send_product_photo(
+                bot,
+                chat_id,
+                product_dict['image'],
                 caption=text,
                 parse_mode=ParseMode.HTML,
                 reply_markup=kb)
 
-            messages.append(mess)
+            messages.append(mess.message_id)
         return messages
     else:
         await bot.send_message(chat_id, "В данной категории отсутствуют товары. Возможно они появятся позже")
 
 
-async def get_products_for_bot(category: str, offset: int = 0) -> list[ProductsGet]:
-    async with async_session() as session:
-        redis = Redis.from_url("redis://localhost:6379", decode_responses=True)
-        try:
-            service = ProductService(session, redis)
-            return await products(category, offset=offset, service=service)
-        finally:
-            await redis.close()
+async def search_view(bot, data, chat_id):
+    messages = []
+    for product in data:
+        inline_kb_list = [[InlineKeyboardButton(text='Купить', callback_data=f"buy_{product['id']}")]]
+        if len(messages) == len(data) - 1:
+            inline_kb_list.append([InlineKeyboardButton(text="Убрать список", callback_data='delete_list')])
+        mess = await send_product_photo(
+            bot,
+            chat_id,
+            product['image'],
+            caption=product_caption(product),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=inline_kb_list))
+        messages.append(mess.message_id)
+    return messages
 
 
-async def get_all_products_for_bot(offset: int = 0) -> list[ProductsGet]:
-    async with async_session() as session:
-        redis = Redis.from_url("redis://localhost:6379", decode_responses=True)
-        try:
-            service = ProductService(session, redis)
-            return await all_products(offset=offset, service=service)
-        finally:
-            await redis.close()
+async def get_products_for_bot(category: str, offset: int = 0, after: str | None = None) -> tuple[list, Page]:
+    service = ProductService(get_redis_client(), async_session)
+    page = await service.get_products(category, offset=offset, after=decode_cursor(after) if after else None)
+    return orjson.loads(page.body), page
+
+
+async def get_all_products_for_bot(offset: int = 0, after: str | None = None) -> tuple[list, Page]:
+    service = ProductService(get_redis_client(), async_session)
+    page = await service.get_all_products(offset=offset, after=decode_cursor(after) if after else None)
+    return orjson.loads(page.body), page
+
+
+def count_pages(page: Page, limit: int = 3) -> int:
+    return (page.total + limit - 1) // limit
+
+
+def page_cursor(cursors: list, page_num: int) -> str | None:
+    if page_num < len(cursors):
+        return cursors[page_num]
+    return None
+
+
+def remember_cursor(cursors: list, page_num: int, cursor: str | None) -> list:
+    cursors = list(cursors)
+    while len(cursors) <= page_num + 1:
+        cursors.append(None)
+    cursors[page_num + 1] = cursor
+    return cursors
+
+
+async def search_products_for_bot(query: str, limit: int = 5) -> tuple[list, Page]:
+    service = ProductService(get_redis_client(), async_session)
+    page = await service.search(query, limit=limit)
+    return orjson.loads(page.body), page